@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Micro benchmarks for the hot paths of a simulation round.
+Every function returns the measured numbers and logs a short summary.
+"""
+
+import os
+import time
+from .ecc import sha256d,SigningKey,VerifyingKey,build_message,batch_verify
+from .datatype import Pointer,Vin,Vout,Tx,Block
+from .consensus import mine,mine_parallel,caculate_target
+from .logger import logger
+
+
+def make_dummy_txs(n,n_out = 2):
+    txs = []
+    for i in range(n):
+        vin = Vin(Pointer(sha256d(os.urandom(32)),0),os.urandom(64),os.urandom(64))
+        tx_out = [Vout('1BwmfFdQwnAz78PcdrzSgBUpRYZbbMSY7L',i+j)
+                  for j in range(n_out)]
+        txs.append(Tx([vin],tx_out,fee = 10))
+    return txs
+
+def bench_tx_id(n = 1000,rounds = 5):
+    txs = make_dummy_txs(n)
+    #add_tx_to_mem_pool,double_payment,remove_txs_from_pool,
+    #find_utxos_from_txs (once per output) and get_merkle_root_of_txs
+    accesses = [tx for tx in txs for _ in range(4 + len(tx.tx_out))]
+
+    start = time.time()
+    for _ in range(rounds):
+        for tx in accesses:
+            sha256d(tx.to_string())
+    before = (time.time() - start)/rounds
+
+    start = time.time()
+    for _ in range(rounds):
+        for tx in accesses:
+            tx.id
+    after = (time.time() - start)/rounds
+
+    logger.info('tx.id for a {0}-tx mempool: {1} accesses per round, '
+                '{2:.6f} secs before, {3:.6f} secs after'.format(
+                        n,len(accesses),before,after))
+    return before,after
+
+
+def bench_mining(bits = 16,n_txs = 100):
+    txs = make_dummy_txs(n_txs)
+    block = Block(0,sha256d(b'prev'),time.time(),bits,0,txs)
+
+    #the string based loop mine() used to run
+    nonce,target,start = 0,caculate_target(bits),time.time()
+    merkle_root_hash = block.merkle_root_hash
+    while int(sha256d(str(block[:4]) + merkle_root_hash + str(nonce)),16) >= target:
+        nonce += 1
+    secs = time.time() - start
+    before = (nonce + 1)/secs if secs > 0 else float('inf')
+
+    report = mine(block,report = True)
+    logger.info('mining at bits={0}: {1:.0f} hashes/sec before, '
+                '{2:.0f} hashes/sec after'.format(bits,before,report.hashrate))
+    return before,report.hashrate
+
+
+def bench_parallel_mining(bits = 22,max_workers = None):
+    max_workers = max_workers or os.cpu_count()
+    block = Block(0,sha256d(b'prev'),time.time(),bits,0,make_dummy_txs(10))
+    hashrates = []
+    for workers in range(1,max_workers + 1):
+        report = mine_parallel(block,workers = workers,report = True)
+        hashrates.append(report.hashrate)
+        logger.info('mining at bits={0} with {1} workers: {2:.0f} hashes/sec, '
+                    '{3:.2f}x of one worker'.format(bits,workers,report.hashrate,
+                                                    report.hashrate/hashrates[0]))
+    return hashrates
+
+
+def bench_batch_verify(n = 500,n_keys = 10,workers = None):
+    workers = workers or os.cpu_count()
+    keys = [SigningKey.from_number(int.from_bytes(os.urandom(32),'big'))
+            for _ in range(n_keys)]
+    triples = []
+    for i in range(n):
+        sk = keys[i % n_keys]
+        message = build_message(str(i))
+        triples.append((sk.get_verifying_key().to_bytes(),sk.sign(message),message))
+
+    #what check_sig does once per input
+    start = time.time()
+    for pubkey,sig,message in triples:
+        VerifyingKey.from_bytes(pubkey).verify(sig,message)
+    before = time.time() - start
+
+    start = time.time()
+    batch_verify(triples)
+    serial = time.time() - start
+
+    start = time.time()
+    batch_verify(triples,workers = workers)
+    parallel = time.time() - start
+
+    logger.info('verifying {0} signatures: {1:.3f} secs one by one, '
+                '{2:.3f} secs batched, {3:.3f} secs batched over {4} workers'.format(
+                        n,before,serial,parallel,workers))
+    return before,serial,parallel
+
+
+if __name__ == "__main__":
+    bench_tx_id()
+    bench_mining()
+    bench_parallel_mining()
+    bench_batch_verify()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Block level bookkeeping of a peer.
+
+OrphanBlockPool keeps blocks whose parent is not known yet, keyed by the
+hash of that parent, so connecting a block finds its waiting children
+with one lookup.
+
+BlockIndex is the block tree of a peer: every known valid block on any
+branch,keyed by hash,with its height and the cumulative work up to it.
+Tx ids are indexed only for the blocks of the main chain.
+
+PropagationReport is how long a block took to reach the peers it was
+broadcast to.
+
+UndoEntry is what connecting one block changed in a peer's utxo set and
+memory pool, so the block can be disconnected again at any depth.
+"""
+
+import time
+from .params import Params
+from .consensus import caculate_target
+
+
+def block_work(bits):
+    return (1 << 256)//caculate_target(bits)
+
+
+"""
+fork choice,the branch with the most work wins and equal work goes to the
+smaller block hash
+"""
+def has_more_work(entry,other):
+    if entry.work != other.work:
+        return entry.work > other.work
+    return int(entry.block.hash,16) < int(other.block.hash,16)
+
+
+class BlockIndexEntry(tuple):
+
+    def __new__(cls,block,height,work):
+        return super(BlockIndexEntry,cls).__new__(cls,(block,height,work))
+
+    @property
+    def block(self):
+        return self[0]
+
+    @property
+    def height(self):
+        return self[1]
+
+    @property
+    def work(self):
+        return self[2]
+
+    @property
+    def parent_hash(self):
+        return self[0].prev_block_hash
+
+    def __repr__(self):
+        return "BlockIndexEntry(hash:{0},height:{1})".format(self[0].hash,self[1])
+
+
+class PropagationReport(tuple):
+
+    def __new__(cls,accepted,secs,latencies):
+        return super(PropagationReport,cls).__new__(cls,(accepted,secs,tuple(latencies)))
+
+    #peers that connected the block
+    @property
+    def accepted(self):
+        return self[0]
+
+    #wall time of the whole broadcast
+    @property
+    def secs(self):
+        return self[1]
+
+    #secs from the broadcast until each peer was done,in peer order
+    @property
+    def latencies(self):
+        return self[2]
+
+    @property
+    def max_latency(self):
+        return max(self[2]) if self[2] else 0.
+
+    def __repr__(self):
+        return "PropagationReport(accepted:{0},secs:{1:.4f},max latency:{2:.4f})".format(
+                self[0],self[1],self.max_latency)
+
+
+class UndoEntry(tuple):
+
+    def __new__(cls,spent,created,pool_utxos,txs_removed):
+        return super(UndoEntry,cls).__new__(cls,(tuple(spent),tuple(created),
+                                                 tuple(pool_utxos),txs_removed))
+
+    #utxos the block spent
+    @property
+    def spent(self):
+        return self[0]
+
+    #pointers of the outputs the block created
+    @property
+    def created(self):
+        return self[1]
+
+    #unconfirmed utxos the outputs replaced
+    @property
+    def pool_utxos(self):
+        return self[2]
+
+    #mem pool txs the block confirmed,tx id -> tx
+    @property
+    def txs_removed(self):
+        return self[3]
+
+    def __repr__(self):
+        return "UndoEntry(spent:{0},created:{1})".format(len(self[0]),len(self[1]))
+
+
+class BlockIndex(object):
+
+    def __init__(self,blocks = ()):
+        self._entries = {}
+        self._children = {}
+        self._tx_blocks = {}
+        self.invalid = set()
+        for block in blocks:
+            self.add(block)
+
+    """
+    index block under its parent,a block without a known parent starts
+    a chain at height 1
+    """
+    def add(self,block):
+        entry = self._entries.get(block.hash)
+        if entry is not None:
+            return entry
+        parent = self._entries.get(block.prev_block_hash)
+        if parent is None:
+            height,work = 1,block_work(block.bits)
+        else:
+            height,work = parent.height + 1,parent.work + block_work(block.bits)
+        entry = BlockIndexEntry(block,height,work)
+        self._entries[block.hash] = entry
+        self._children.setdefault(block.prev_block_hash,{})[block.hash] = None
+        return entry
+
+    def remove(self,block_hash):
+        entry = self._entries.pop(block_hash)
+        children = self._children.get(entry.parent_hash)
+        if children is not None:
+            children.pop(block_hash,None)
+            if not children:
+                del self._children[entry.parent_hash]
+        self.unindex_txs(entry.block)
+        return entry
+
+    """
+    drop block_hash and every block built on it,their hashes are kept in
+    invalid so they are not indexed again
+    """
+    def remove_invalid(self,block_hash):
+        removed,queue = [],[block_hash]
+        while queue:
+            h = queue.pop()
+            queue.extend(self._children.get(h,()))
+            if h in self._entries:
+                removed.append(self.remove(h))
+            self.invalid.add(h)
+        return removed
+
+    #called when block joins or leaves the main chain
+    def index_txs(self,block):
+        for tx in block.txs:
+            self._tx_blocks[tx.id] = block.hash
+
+    def unindex_txs(self,block):
+        for tx in block.txs:
+            if self._tx_blocks.get(tx.id) == block.hash:
+                del self._tx_blocks[tx.id]
+
+    def get(self,block_hash):
+        return self._entries.get(block_hash)
+
+    def parent_of(self,block_hash):
+        entry = self._entries.get(block_hash)
+        return self._entries.get(entry.parent_hash) if entry else None
+
+    def block_of_tx(self,tx_id):
+        return self._tx_blocks.get(tx_id)
+
+    def copy(self):
+        other = BlockIndex()
+        other._entries = self._entries.copy()
+        other._children = {h:children.copy() for h,children in self._children.items()}
+        other._tx_blocks = self._tx_blocks.copy()
+        other.invalid = self.invalid.copy()
+        return other
+
+    def __contains__(self,block_hash):
+        return block_hash in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "BlockIndex(blocks:{0})".format(len(self._entries))
+
+
+class OrphanBlockPool(object):
+
+    def __init__(self,max_blocks = None,expire_time = None):
+        self.max_blocks = max_blocks or Params.MAX_ORPHAN_BLOCKS
+        self.expire_time = expire_time or Params.ORPHAN_BLOCK_EXPIRE_TIME
+        self._blocks = {}
+        self._children = {}
+
+    def add(self,block):
+        if block.hash in self._blocks:
+            return False
+        self.expire()
+        while len(self._blocks) >= self.max_blocks:
+            self.remove(next(iter(self._blocks)))
+        self._blocks[block.hash] = (block,time.time() + self.expire_time)
+        self._children.setdefault(block.prev_block_hash,{})[block.hash] = None
+        return True
+
+    def remove(self,block_hash):
+        block,_ = self._blocks.pop(block_hash)
+        children = self._children[block.prev_block_hash]
+        del children[block_hash]
+        if not children:
+            del self._children[block.prev_block_hash]
+        return block
+
+    """
+    take out every orphan whose parent is block_hash
+    """
+    def pop_children(self,block_hash):
+        hashes = self._children.get(block_hash)
+        if not hashes:
+            return []
+        return [self.remove(h) for h in list(hashes)]
+
+    #orphans are kept in arrival order,so expired ones are all at the front
+    def expire(self,now = None):
+        now = now or time.time()
+        expired = []
+        for block_hash,(_,deadline) in self._blocks.items():
+            if deadline > now:
+                break
+            expired.append(block_hash)
+        return [self.remove(h) for h in expired]
+
+    def get(self,block_hash):
+        entry = self._blocks.get(block_hash)
+        return entry[0] if entry else None
+
+    def __contains__(self,block_hash):
+        return block_hash in self._blocks
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __repr__(self):
+        return "OrphanBlockPool(blocks:{0})".format(len(self._blocks))
@@ -3,27 +3,201 @@
 """
 
 
-from .ecc import sha256d
+from .params import Params
+from .logger import logger
+from hashlib import sha256
+from concurrent.futures import ProcessPoolExecutor,wait,FIRST_COMPLETED
+import multiprocessing
+import os
+import random
+import struct
 import time 
 
+MAX_NONCE = (1 << 64) - 1
+
+_pack_nonce = struct.Struct('<Q').pack
+
+
+class MiningReport(tuple):
+
+    def __new__(cls,nonce,hashes,secs):
+        return super(MiningReport,cls).__new__(cls,(nonce,hashes,secs))
+
+    @property
+    def nonce(self):
+        return self[0]
+
+    @property
+    def hashes(self):
+        return self[1]
+
+    @property
+    def secs(self):
+        return self[2]
+
+    @property
+    def hashrate(self):
+        return self[1]/self[2] if self[2] > 0 else float('inf')
+
+    def __repr__(self):
+        return "MiningReport(nonce:{0},hashes:{1},hashrate:{2:.0f}/s)".format(
+                self[0],self[1],self.hashrate)
+
 
 def caculate_target(bits):
     return (1 << (256 - bits))
 
-def mine(block):
-    nonce = 0
-    target = caculate_target(block.bits)
-    merkle_root_hash = block.get_merkle_root()
-    while int(sha256d(block.header(nonce,merkle_root_hash)), 16) >= target:
-        nonce += 1
-    
+#the largest acceptable double sha256 digest,as big-endian bytes
+def target_to_bytes(bits):
+    return (caculate_target(bits) - 1).to_bytes(32,'big')
+
+"""
+hash prefix + nonce for nonce in [start,stop),the prefix is hashed only
+once and its midstate copied for every nonce
+return (nonce,hashes) or (None,hashes) if the range is exhausted
+"""
+def search_nonce(prefix,bits,start = 0,stop = MAX_NONCE + 1):
+    limit = target_to_bytes(bits)
+    copy = sha256(prefix).copy
+    for nonce in range(start,stop):
+        h = copy()
+        h.update(_pack_nonce(nonce))
+        if sha256(h.digest()).digest() <= limit:
+            return nonce,nonce - start + 1
+    return None,stop - start
+
+def mine(block,report = False):
+    start = time.time()
+    prefix = block.header_prefix(block.merkle_root_hash)
+    nonce,hashes = search_nonce(prefix,block.bits)
+    if report:
+        return MiningReport(nonce,hashes,time.time() - start)
     return nonce
 
 
-def consensus_with_fasttest_minner(peers):
+_found = None
+
+def _init_miner(found):
+    global _found
+    _found = found
+
+#scan chunks first,first+stride,... until a nonce is found anywhere
+def _search_chunks(prefix,bits,first,stride,chunk):
+    hashes,i = 0,first
+    while not _found.is_set():
+        start = i*chunk
+        if start > MAX_NONCE:
+            break
+        nonce,n = search_nonce(prefix,bits,start,min(start + chunk,MAX_NONCE + 1))
+        hashes += n
+        if nonce is not None:
+            _found.set()
+            return nonce,hashes
+        i += stride
+    return None,hashes
+
+"""
+split the nonce space over worker processes,the first worker that finds
+a valid nonce stops the others,the result is the same as mine()
+"""
+def mine_parallel(block,workers = None,report = False,chunk = None):
+    workers = workers or Params.MINING_WORKERS or os.cpu_count()
+    chunk = chunk or Params.MINING_CHUNK_SIZE
+    start = time.time()
+    prefix = block.header_prefix(block.merkle_root_hash)
+    found = multiprocessing.Event()
+    with ProcessPoolExecutor(max_workers = workers,
+                             initializer = _init_miner,
+                             initargs = (found,)) as executor:
+        futures = [executor.submit(_search_chunks,prefix,block.bits,i,workers,chunk)
+                   for i in range(workers)]
+        pending = futures
+        while pending and not found.is_set():
+            _,pending = wait(pending,return_when = FIRST_COMPLETED)
+        found.set()
+        results = [f.result() for f in futures]
+
+    nonces = [nonce for nonce,_ in results if nonce is not None]
+    nonce = min(nonces) if nonces else None
+    if report:
+        hashes = sum(n for _,n in results)
+        return MiningReport(nonce,hashes,time.time() - start)
+    return nonce
+
+
+#one miner of a race,it scans from nonce 0 until any miner has won
+def _race_miner(prefix,bits,chunk):
+    hashes,start,begin = 0,0,time.time()
+    while not _found.is_set() and start <= MAX_NONCE:
+        nonce,n = search_nonce(prefix,bits,start,min(start + chunk,MAX_NONCE + 1))
+        hashes += n
+        if nonce is not None:
+            _found.set()
+            return nonce,hashes,time.time() - begin
+        start += chunk
+    return None,hashes,time.time() - begin
+
+"""
+all peers mine their own candidate blocks at the same time in separate
+processes,the first one to finish wins and stops the others
+"""
+def race(peers,chunk = None):
+    chunk = chunk or Params.MINING_CHUNK_SIZE
+    for peer in peers:
+        peer.create_candidate_block()
+        peer._is_block_candidate_created = False
+    prefixes = [(peer.candidate_block.header_prefix(peer.candidate_block.merkle_root_hash),
+                 peer.candidate_block.bits) for peer in peers]
+
+    start = time.time()
+    found = multiprocessing.Event()
+    with ProcessPoolExecutor(max_workers = len(peers),
+                             initializer = _init_miner,
+                             initargs = (found,)) as executor:
+        futures = [executor.submit(_race_miner,prefix,bits,chunk)
+                   for prefix,bits in prefixes]
+        winner,pending = None,futures
+        while winner is None and pending:
+            done,pending = wait(pending,return_when = FIRST_COMPLETED)
+            finished = [f for f in done if f.result()[0] is not None]
+            if finished:
+                winner = min(finished,key = lambda f:f.result()[2])
+        found.set()
+        time_spent = time.time() - start
+        results = [f.result() for f in futures]
+
+    for peer,(_,hashes,secs) in zip(peers,results):
+        peer.hashrate = hashes/secs if secs > 0 else 0
+        logger.info('{0}(pid={1}) mined at {2:.0f} hashes/sec'.format(
+                peer,peer.pid,peer.hashrate))
+    n = futures.index(winner)
+    return n,results[n][0],time_spent
+
+
+"""
+no hashing at all: every peer finds a block after an exponentially
+distributed time with rate hashrate*target/2**256,the earliest one wins
+"""
+def simulate_mining(peers,bits = None):
+    bits = Params.INITIAL_DIFFICULTY_BITS if bits is None else bits
+    p = caculate_target(bits)/(1 << 256)
+    times = [random.expovariate((peer.hashrate or Params.DEFAULT_HASHRATE)*p)
+             for peer in peers]
+    n = times.index(min(times))
+    peers[n].create_candidate_block()
+    peers[n]._is_block_candidate_created = False
+    return n,peers[n].candidate_block.nonce,times[n]
+
+
+def consensus_with_fasttest_minner(peers,meth = 'pow'):
+    if meth == 'race':
+        return race(peers)
+    if meth == 'stat':
+        return simulate_mining(peers)
+    
     l,start = [],time.time()
     for peer in peers:
-        l.append(peer.consensus())
+        l.append(peer.consensus(meth))
     return l.index(min(l)),min(l),time.time()-start
 
 
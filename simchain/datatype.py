@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
 import os 
+from functools import lru_cache
 from .ecc import sha256d
+from .serialize import (SERIAL_VERSION,NULL_HASH,SerializationError,
+                        write_varint,read_varint,write_hash,read_hash,
+                        write_str,read_str,write_value,read_value,
+                        read_uint8,write_uint64,read_uint64,read_version)
 
 #A pointer to a transaction unspent output
 class Pointer(tuple):
@@ -17,6 +22,19 @@ class Pointer(tuple):
     def n(self):
         return self[1]
     
+    def serialize(self):
+        return write_hash(self[0]) + write_varint(self[1])
+
+    @classmethod
+    def read_from(cls,buf,offset = 0):
+        tx_id,offset = read_hash(buf,offset)
+        n,offset = read_varint(buf,offset)
+        return cls(tx_id,n),offset
+
+    @classmethod
+    def deserialize(cls,data):
+        return _deserialize(cls,data)
+
     def __repr__(self):
         return "Pointer(tx_id:{0},n:{1})".format(self[0],self[1])
     
@@ -45,10 +63,34 @@ class Vin(tuple):
     def sig_script(self):
         return self[1]+self[2]
 
+    #a coinbase input spends nothing and is written as a null pointer
+    def serialize(self):
+        to_spend = self[0].serialize() if self[0] is not None else NULL_HASH + b'\x00'
+        return to_spend + write_value(self[1]) + write_value(self[2])
+
+    @classmethod
+    def read_from(cls,buf,offset = 0):
+        to_spend,offset = Pointer.read_from(buf,offset)
+        if to_spend.tx_id is None:
+            to_spend = None
+        signature,offset = read_value(buf,offset)
+        pubkey,offset = read_value(buf,offset)
+        return cls(to_spend,signature,pubkey),offset
+
+    @classmethod
+    def deserialize(cls,data):
+        return _deserialize(cls,data)
+
     def __repr__(self):
         return "Vin(to_spend:{0},signature:{1},pubkey:{2})".format(self[0],self[1],self[2])
     
 
+#pay to address script,formatted once per address
+@lru_cache(maxsize = 1 << 16)
+def pubkey_script_of(addr):
+    return "OP_DUP OP_ADDR {0} OP_EQ OP_CHECKSIG".format(addr)
+
+
 #value output for a transaction
 class Vout(tuple):
     
@@ -66,8 +108,20 @@ class Vout(tuple):
 
     @property
     def pubkey_script(self):
-        script = "OP_DUP OP_ADDR {0} OP_EQ OP_CHECKSIG".format(self[0])
-        return script
+        return pubkey_script_of(self[0])
+
+    def serialize(self):
+        return write_str(self[0]) + write_value(self[1])
+
+    @classmethod
+    def read_from(cls,buf,offset = 0):
+        to_addr,offset = read_str(buf,offset)
+        value,offset = read_value(buf,offset)
+        return cls(to_addr,value),offset
+
+    @classmethod
+    def deserialize(cls,data):
+        return _deserialize(cls,data)
 
     def __repr__(self):
         return "Vout(to_addr:{0},value:{1})".format(self[0],self[1])
@@ -116,20 +170,50 @@ class UTXO(tuple):
 
     def _replace(self,unspent = True, confirmed = False):
         return UTXO(self[0],self[1],self[2],unspent,confirmed)
+
+    #the three flags share one byte
+    def serialize(self):
+        flags = bool(self[2]) | bool(self[3]) << 1 | bool(self[4]) << 2
+        return self[1].serialize() + self[0].serialize() + bytes((flags,))
+
+    @classmethod
+    def read_from(cls,buf,offset = 0):
+        pointer,offset = Pointer.read_from(buf,offset)
+        vout,offset = Vout.read_from(buf,offset)
+        flags,offset = read_uint8(buf,offset)
+        return cls(vout,pointer,bool(flags & 1),bool(flags & 2),bool(flags & 4)),offset
+
+    @classmethod
+    def deserialize(cls,data):
+        return _deserialize(cls,data)
     
     def __repr__(self):
         return "UTXO(vout:{0},pointer:{1})".format(self[0],self[1])
 
 
 #transaction
+#tx_in and tx_out are frozen into tuples, so the id is hashed only once
 class Tx(tuple):
     
     def __new__(cls,tx_in,tx_out,fee=0,timestamp=0,nlocktime=0):
-        return super(Tx,cls).__new__(cls,(tx_in,
-                                          tx_out,
+        self = super(Tx,cls).__new__(cls,(tuple(tx_in),
+                                          tuple(tx_out),
                                           fee,
                                           timestamp,
                                           nlocktime))
+        raw = self.serialize()
+        object.__setattr__(self,'_id',sha256d(raw))
+        object.__setattr__(self,'_size',len(raw))
+        return self
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    def __setattr__(self,name,value):
+        raise AttributeError("Tx is immutable")
+
+    def __hash__(self):
+        return hash(self._id)
         
     @property
     def tx_in(self):
@@ -163,31 +247,85 @@ class Tx(tuple):
 
     @property
     def id(self):
-        return sha256d(self.to_string())
+        return self._id
+
+    @property
+    def size(self):
+        return self._size
     
     def to_string(self):
         return "{0}{1}{2}".format(self[0],
                                   self[1],
                                   self[3])
 
+    def serialize(self):
+        parts = [bytes((SERIAL_VERSION,)),write_varint(len(self[0]))]
+        parts += [vin.serialize() for vin in self[0]]
+        parts.append(write_varint(len(self[1])))
+        parts += [vout.serialize() for vout in self[1]]
+        parts += [write_value(self[2]),write_value(self[3]),write_varint(self[4])]
+        return b''.join(parts)
+
+    @classmethod
+    def read_from(cls,buf,offset = 0):
+        _,offset = read_version(buf,offset)
+        n,offset = read_varint(buf,offset)
+        tx_in = []
+        for _ in range(n):
+            vin,offset = Vin.read_from(buf,offset)
+            tx_in.append(vin)
+        n,offset = read_varint(buf,offset)
+        tx_out = []
+        for _ in range(n):
+            vout,offset = Vout.read_from(buf,offset)
+            tx_out.append(vout)
+        fee,offset = read_value(buf,offset)
+        timestamp,offset = read_value(buf,offset)
+        nlocktime,offset = read_varint(buf,offset)
+        return cls(tx_in,tx_out,fee,timestamp,nlocktime),offset
+
+    @classmethod
+    def deserialize(cls,data):
+        return _deserialize(cls,data)
+
     def __repr__(self):
         return "Tx(id:{0})".format(self.id)
 
 
 #block
+#merkle root,header bytes and hash are computed once at construction,
+#merkle_root_hash may be passed in when it is already known for txs
 class Block(tuple): 
     def __new__(cls,version,
                 prev_block_hash,
                 timestamp,
                 bits,
                 nonce,
-                txs):
-        return super(Block,cls).__new__(cls,(version,
+                txs,
+                merkle_root_hash = None):
+        txs = tuple(txs)
+        self = super(Block,cls).__new__(cls,(version,
                                              prev_block_hash,
                                              timestamp,
                                              bits,
                                              nonce,
                                              txs))
+        if merkle_root_hash is None and txs:
+            merkle_root_hash = get_merkle_root_of_txs(txs)
+        header = self.header_prefix(merkle_root_hash) + write_uint64(nonce)
+        object.__setattr__(self,'_merkle_root',merkle_root_hash)
+        object.__setattr__(self,'_header',header)
+        object.__setattr__(self,'_hash',sha256d(header))
+        return self
+
+    def __getnewargs__(self):
+        return tuple(self) + (self._merkle_root,)
+
+    def __setattr__(self,name,value):
+        raise AttributeError("Block is immutable")
+
+    def __hash__(self):
+        return hash(self._hash)
         
     
     @property
@@ -216,7 +354,7 @@ class Block(tuple):
 
     @property
     def merkle_root_hash(self):
-        return self.get_merkle_root()
+        return self._merkle_root
 
     def _replace(self,nonce = 0):
         return Block(self[0],
@@ -224,30 +362,162 @@ class Block(tuple):
                      self[2],
                      self[3],
                      nonce,
-                     self[5])
+                     self[5],
+                     self._merkle_root)
 
     def get_merkle_root(self):
-        return get_merkle_root_of_txs(self.txs) if self.txs else None
+        return self._merkle_root
+
+    #everything in the header but the nonce,which is always the last 8 bytes
+    def header_prefix(self,merkle_root_hash = None):
+        return b''.join((write_varint(self[0]),
+                         write_hash(self[1]),
+                         write_value(self[2]),
+                         write_varint(self[3]),
+                         write_hash(merkle_root_hash)))
     
     def header(self,nonce = None,merkle_root_hash = None):
+        if nonce is None and merkle_root_hash is None:
+            return self._header
         if merkle_root_hash is None:
-            merkle_root_hash = self.get_merkle_root()
-            
-        return "{0}{1}{2}{3}{4}{5}".format(self[0],
-                                           self[1],
-                                           self[2],
-                                           self[3],
-                                           merkle_root_hash,
-                                           nonce or self[4])
+            merkle_root_hash = self._merkle_root
+        if nonce is None:
+            nonce = self[4]
+        return self.header_prefix(merkle_root_hash) + write_uint64(nonce)
 
     @property
     def hash(self):
-        return sha256d(self.header())
+        return self._hash
+
+    def serialize(self):
+        parts = [bytes((SERIAL_VERSION,)),
+                 self._header,
+                 write_varint(len(self[5]))]
+        parts += [tx.serialize() for tx in self[5]]
+        return b''.join(parts)
+
+    @classmethod
+    def read_from(cls,buf,offset = 0):
+        _,offset = read_version(buf,offset)
+        version,offset = read_varint(buf,offset)
+        prev_block_hash,offset = read_hash(buf,offset)
+        timestamp,offset = read_value(buf,offset)
+        bits,offset = read_varint(buf,offset)
+        merkle_root_hash,offset = read_hash(buf,offset)
+        nonce,offset = read_uint64(buf,offset)
+        n,offset = read_varint(buf,offset)
+        txs = []
+        for _ in range(n):
+            tx,offset = Tx.read_from(buf,offset)
+            txs.append(tx)
+        block = cls(version,prev_block_hash,timestamp,bits,nonce,txs)
+        if block.merkle_root_hash != merkle_root_hash:
+            raise SerializationError('merkle root does not match txs')
+        return block,offset
+
+    @classmethod
+    def deserialize(cls,data):
+        return _deserialize(cls,data)
 
     def __repr__(self):
         return "Block(hash:{0})".format(self.hash)
 
 
+#A block without its txs,what peers exchange before fetching bodies
+class BlockHeader(tuple):
+    def __new__(cls,version,
+                prev_block_hash,
+                timestamp,
+                bits,
+                merkle_root_hash,
+                nonce):
+        self = super(BlockHeader,cls).__new__(cls,(version,
+                                                   prev_block_hash,
+                                                   timestamp,
+                                                   bits,
+                                                   merkle_root_hash,
+                                                   nonce))
+        object.__setattr__(self,'_hash',sha256d(self.serialize()))
+        return self
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    def __setattr__(self,name,value):
+        raise AttributeError("BlockHeader is immutable")
+
+    def __hash__(self):
+        return hash(self._hash)
+
+    @classmethod
+    def from_block(cls,block):
+        return cls(block.version,block.prev_block_hash,block.timestamp,
+                   block.bits,block.merkle_root_hash,block.nonce)
+
+    @property
+    def version(self):
+        return self[0]
+
+    @property
+    def prev_block_hash(self):
+        return self[1]
+
+    @property
+    def timestamp(self):
+        return self[2]
+
+    @property
+    def bits(self):
+        return self[3]
+
+    @property
+    def merkle_root_hash(self):
+        return self[4]
+
+    @property
+    def nonce(self):
+        return self[5]
+
+    @property
+    def hash(self):
+        return self._hash
+
+    #the same bytes as Block.header(),so both hash alike
+    def serialize(self):
+        return b''.join((write_varint(self[0]),
+                         write_hash(self[1]),
+                         write_value(self[2]),
+                         write_varint(self[3]),
+                         write_hash(self[4]),
+                         write_uint64(self[5])))
+
+    @classmethod
+    def read_from(cls,buf,offset = 0):
+        version,offset = read_varint(buf,offset)
+        prev_block_hash,offset = read_hash(buf,offset)
+        timestamp,offset = read_value(buf,offset)
+        bits,offset = read_varint(buf,offset)
+        merkle_root_hash,offset = read_hash(buf,offset)
+        nonce,offset = read_uint64(buf,offset)
+        return cls(version,prev_block_hash,timestamp,bits,merkle_root_hash,nonce),offset
+
+    @classmethod
+    def deserialize(cls,data):
+        return _deserialize(cls,data)
+
+    def __repr__(self):
+        return "BlockHeader(hash:{0})".format(self.hash)
+
+
+
+def _deserialize(cls,data):
+    buf = data if isinstance(data,memoryview) else memoryview(data)
+    obj,offset = cls.read_from(buf,0)
+    if offset != len(buf):
+        raise SerializationError('{0} trailing bytes after {1}'.format(
+                len(buf) - offset,cls.__name__))
+    return obj
+
 
 def get_merkle_root_of_txs(txs):
     return get_merkle_root([tx.id for tx in txs])
@@ -271,11 +541,12 @@ def pair_node(l):
 
 
 if __name__ == "__main__":
-    p = Pointer(1,2)
-    vout = Vout(1,2)
-    utxo = UTXO((1,2),[2,3],True,1)
+    p = Pointer(sha256d(b'1'),2)
+    vout = Vout('1BwmfFdQwnAz78PcdrzSgBUpRYZbbMSY7L',2)
+    utxo = UTXO(vout,p,True,1)
     vin = Vin(p,b'1',b'12')
     tx = Tx([vin],[vout])
-    block = Block(1,2,3,4,5,[tx])
+    block = Block(1,sha256d(b'2'),3,4,5,[tx])
+    assert Block.deserialize(block.serialize()) == block
     
     
@@ -5,6 +5,8 @@ import math
 
 import struct
 import binascii
+import time
+from concurrent.futures import ProcessPoolExecutor
 from random import SystemRandom
 from hashlib import sha256,new
 from .base58 import b58encode_check,b58decode_check
@@ -158,6 +160,8 @@ class CurveFp(object):
 
 
 class Point(object):
+
+    __slots__ = ('curve','x','y','order')
     
     def __init__(self, curve, x, y, order=None):
         
@@ -171,6 +175,16 @@ class Point(object):
         if order:
             assert self * order == INFINITY
 
+    #points computed here are on the curve by construction
+    @classmethod
+    def _trusted(cls, curve, x, y, order=None):
+        self = object.__new__(cls)
+        self.curve = curve
+        self.x = x
+        self.y = y
+        self.order = order
+        return self
+
     def __eq__(self, other):
         """Is this point equals to another"""
         if self.curve == other.curve \
@@ -202,9 +216,10 @@ class Point(object):
         x3 = (l * l - self.x - other.x) % p
         y3 = (l * (self.x - x3) - self.y) % p
 
-        return Point(self.curve, x3, y3)
+        return Point._trusted(self.curve, x3, y3)
 
     def __mul__(self, other):
+        """Multiply in jacobian coordinates,one inversion at the end."""
         e = other
         if self.order:
             e = e % self.order
@@ -213,19 +228,11 @@ class Point(object):
         if self == INFINITY:
             return INFINITY
 
-        e3 = 3 * e
-        negative_self = Point(self.curve, self.x, -self.y, self.order)
-        i = leftmost_bit(e3) // 2
-        result = self
-        
-        while i > 1:
-            result = result.double()
-            if (e3 & i) != 0 and (e & i) == 0:
-                result = result + self
-            if (e3 & i) == 0 and (e & i) != 0:
-                result = result + negative_self
-            i = i // 2
-        return result
+        curve = self.curve
+        xy = _to_affine(_jacobian_mul((self.x, self.y, 1), e, curve), curve.p)
+        if xy is None:
+            return INFINITY
+        return Point._trusted(curve, xy[0], xy[1])
 
     def __rmul__(self, other):
         """Multiply a point by an integer."""
@@ -249,7 +256,7 @@ class Point(object):
         x3 = (l * l - 2 * self.x) % p
         y3 = (l * (self.x - x3) - self.y) % p
 
-        return Point(self.curve, x3, y3)
+        return Point._trusted(self.curve, x3, y3)
 
     def invert(self):
         return Point(self.curve,self.x,-self.y % self.curve.p)
@@ -257,6 +264,111 @@ class Point(object):
 
 INFINITY = Point(None, None, None)
 
+
+# =============================================================================
+#jacobian coordinates,(X,Y,Z) is the affine point (X/Z^2,Y/Z^3) and Z = 0
+#is infinity,additions and doublings need no inversion
+
+_JACOBIAN_INFINITY = (1, 1, 0)
+
+def _jacobian_double(P, curve):
+    X, Y, Z = P
+    if not Z or not Y:
+        return _JACOBIAN_INFINITY
+    p = curve.p
+    YY = Y * Y % p
+    S = 4 * X * YY % p
+    M = 3 * X * X
+    if curve.a:
+        M += curve.a * pow(Z, 4, p)
+    M %= p
+    X3 = (M * M - 2 * S) % p
+    Y3 = (M * (S - X3) - 8 * YY * YY) % p
+    return X3, Y3, 2 * Y * Z % p
+
+def _jacobian_add(P, Q, curve):
+    X1, Y1, Z1 = P
+    X2, Y2, Z2 = Q
+    if not Z1:
+        return Q
+    if not Z2:
+        return P
+    p = curve.p
+    Z1Z1 = Z1 * Z1 % p
+    U2, S2 = X2 * Z1Z1 % p, Y2 * Z1 * Z1Z1 % p
+    #Q is usually affine,Z2 = 1
+    if Z2 == 1:
+        U1, S1 = X1, Y1
+    else:
+        Z2Z2 = Z2 * Z2 % p
+        U1, S1 = X1 * Z2Z2 % p, Y1 * Z2 * Z2Z2 % p
+    H, r = (U2 - U1) % p, (S2 - S1) % p
+    if not H:
+        if not r:
+            return _jacobian_double(P, curve)
+        return _JACOBIAN_INFINITY
+    HH = H * H % p
+    HHH = H * HH % p
+    V = U1 * HH % p
+    X3 = (r * r - HHH - 2 * V) % p
+    Y3 = (r * (V - X3) - S1 * HHH) % p
+    return X3, Y3, Z1 * Z2 * H % p
+
+def _to_affine(P, p):
+    X, Y, Z = P
+    if not Z:
+        return None
+    zi = inv_mod(Z, p)
+    zi2 = zi * zi % p
+    return X * zi2 % p, Y * zi2 * zi % p
+
+def _jacobian_mul(P, e, curve):
+    """the same signed bit walk Point.__mul__ used with affine points"""
+    if not e or not P[2]:
+        return _JACOBIAN_INFINITY
+    X, Y, Z = P
+    negative = (X, -Y % curve.p, Z)
+    e3 = 3 * e
+    i = leftmost_bit(e3) // 2
+    result = P
+    while i > 1:
+        result = _jacobian_double(result, curve)
+        if (e3 & i) != 0 and (e & i) == 0:
+            result = _jacobian_add(result, P, curve)
+        if (e3 & i) == 0 and (e & i) != 0:
+            result = _jacobian_add(result, negative, curve)
+        i = i // 2
+    return result
+
+def _shamir_mul(P, a, Q, b, curve):
+    """a*P + b*Q with one shared run of doublings"""
+    PQ = _jacobian_add(P, Q, curve)
+    xy = _to_affine(PQ, curve.p)
+    PQ = _JACOBIAN_INFINITY if xy is None else (xy[0], xy[1], 1)
+    R = _JACOBIAN_INFINITY
+    for i in range(max(a.bit_length(), b.bit_length()) - 1, -1, -1):
+        R = _jacobian_double(R, curve)
+        bits = (a >> i & 1, b >> i & 1)
+        if bits == (1, 1):
+            R = _jacobian_add(R, PQ, curve)
+        elif bits == (1, 0):
+            R = _jacobian_add(R, P, curve)
+        elif bits == (0, 1):
+            R = _jacobian_add(R, Q, curve)
+    return R
+
+def shamir_mul(P, a, Q, b):
+    """a*P + b*Q for two points of the same curve"""
+    if P == INFINITY:
+        return Q * b
+    if Q == INFINITY:
+        return P * a
+    curve = P.curve
+    xy = _to_affine(_shamir_mul((P.x, P.y, 1), a, (Q.x, Q.y, 1), b, curve), curve.p)
+    if xy is None:
+        return INFINITY
+    return Point._trusted(curve, xy[0], xy[1])
+
 def show_points(p,a,b):
     return [(x, y) for x in range(p) for y in range(p)
             if (y*y-(x*x*x+a*x+b))%p ==0]
@@ -479,10 +591,15 @@ class VerifyingKey(object):
     def verify(self,sig,message,sigdecode = sigdecode_string):
         r,s = sigdecode(sig,self.baselen)
         K,n,G = self.point,self.order,self.generator
+        #the same range batch_verify accepts
+        if not (0 < r < n and 0 < s < n):
+            return False
         h = bytes_to_number(message)
         w = inv_mod(s,n)
         u1, u2 = (h * w) % n,(r * w) % n
-        p = u1 * G + u2 * K
+        p = shamir_mul(G,u1,K,u2)
+        if p == INFINITY:
+            return False
         return r == p.x % n
     
 
@@ -546,10 +663,116 @@ def verify(sig,G,K,message):
     h = bytes_to_number(mess_hash)
     w = inv_mod(s,n)
     u1, u2 = (h * w) % n,(r * w) % n
-    p = u1 * G + u2 * K
+    p = shamir_mul(G,u1,K,u2)
+    if p == INFINITY:
+        return False
     return r == p.x % n 
 
 
+# =============================================================================
+#batch verification
+
+#generator multiples,_g_table[i][j] = j*16**i*G as affine (x,y)
+_WINDOW = 4
+_g_table = None
+
+#totals over all batch_verify calls of this process
+batch_verify_stats = {'batches':0,'signatures':0,'secs':0.}
+
+def _affine_add(P,Q,curve = curve_secp256k1):
+    if P is None:
+        return Q
+    if Q is None:
+        return P
+    p = curve.p
+    (x1,y1),(x2,y2) = P,Q
+    if x1 == x2:
+        if (y1 + y2) % p == 0:
+            return None
+        l = ((3 * x1 * x1 + curve.a) * inv_mod(2 * y1, p)) % p
+    else:
+        l = ((y2 - y1) * inv_mod(x2 - x1, p)) % p
+    x3 = (l * l - x1 - x2) % p
+    return x3,(l * (x1 - x3) - y1) % p
+
+def generator_table():
+    global _g_table
+    if _g_table is None:
+        rows,base = [],(_Gx,_Gy)
+        for _ in range((_r.bit_length() + _WINDOW - 1)//_WINDOW):
+            row = [None,base]
+            for _ in range(2,1 << _WINDOW):
+                row.append(_affine_add(row[-1],base))
+            rows.append(row)
+            base = _affine_add(row[-1],base)
+        _g_table = rows
+    return _g_table
+
+#e*G in jacobian coordinates,one addition per 4 bits of e and no doublings
+def _mul_generator(e):
+    table,e,R,i = generator_table(),e % _r,_JACOBIAN_INFINITY,0
+    while e:
+        entry = table[i][e & 15]
+        if entry is not None:
+            R = _jacobian_add(R,(entry[0],entry[1],1),curve_secp256k1)
+        e >>= _WINDOW
+        i += 1
+    return R
+
+"""
+e*G as affine (x,y) from the precomputed table,None for infinity
+"""
+def mul_generator(e):
+    return _to_affine(_mul_generator(e),_p)
+
+def _verify_triple(pubkey,sig,message):
+    try:
+        l = secp256k1.baselen
+        x,y = bytes_to_number(pubkey[:l]),bytes_to_number(pubkey[l:])
+        #secp256k1 has cofactor 1,every point on the curve has order n
+        if not curve_secp256k1.contains_point(x,y):
+            return False
+        r,s = sigdecode_string(sig,l)
+        n = _r
+        if not (0 < r < n and 0 < s < n):
+            return False
+        h = bytes_to_number(message)
+        w = inv_mod(s,n)
+        u1, u2 = (h * w) % n,(r * w) % n
+        R = _jacobian_add(_mul_generator(u1),
+                          _jacobian_mul((x,y,1),u2,curve_secp256k1),
+                          curve_secp256k1)
+        P = _to_affine(R,_p)
+        return P is not None and r == P[0] % n
+    except Exception:
+        return False
+
+def _verify_triples(triples):
+    return [_verify_triple(*triple) for triple in triples]
+
+"""
+verify (pubkey,signature,message) triples of secp256k1 keys as
+VerifyingKey.verify does,returns one bool per triple,workers > 1 splits
+them over a process pool
+"""
+def batch_verify(triples,workers = None):
+    triples = list(triples)
+    workers = workers or 1
+    start = time.time()
+    if workers > 1 and len(triples) > workers:
+        size = -(-len(triples)//workers)
+        chunks = [triples[i:i+size] for i in range(0,len(triples),size)]
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            results = [ok for chunk in executor.map(_verify_triples,chunks)
+                       for ok in chunk]
+    else:
+        results = _verify_triples(triples)
+    batch_verify_stats['batches'] += 1
+    batch_verify_stats['signatures'] += len(triples)
+    batch_verify_stats['secs'] += time.time() - start
+    return results
+
+
 
 
 #######Try all possibilities
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Memory pool of unconfirmed transactions.
+
+MemPool maps tx id -> tx like the dict peers used before, and also keeps
+an index of which pool transaction spends each pointer, so a double spend
+is found with one lookup per input.
+
+Transactions are ranked by fee per byte in two lazily cleaned heaps, one
+for building block templates from the best end and one for evicting from
+the worst end once the pool goes over its count or byte cap. An evicted
+transaction takes the pool transactions spending its outputs with it.
+
+Watchers,such as a BlockTemplate,are told about every transaction that
+enters or leaves the pool through tx_added(tx),tx_removed(tx) and clear().
+"""
+
+import heapq
+import time
+from collections.abc import MutableMapping
+from itertools import count
+from .datatype import Pointer
+from .params import Params
+
+
+def feerate(tx):
+    return tx.fee/tx.size
+
+
+class MemPool(MutableMapping):
+
+    def __init__(self,txs = None,max_txs = None,max_size = None):
+        self.max_txs = max_txs or Params.MAX_TXS_IN_MEM_POOL
+        self.max_size = max_size or Params.MAX_MEM_POOL_SIZE
+        self.size = 0
+        self._txs = {}
+        self._spent = {}
+        self._seq = {}
+        self._best = []
+        self._worst = []
+        self._counter = count()
+        self.watchers = []
+        if txs:
+            self.update(txs)
+
+    def __getitem__(self,tx_id):
+        return self._txs[tx_id]
+
+    def __setitem__(self,tx_id,tx):
+        self.add(tx,tx_id)
+
+    """
+    add tx and return the transactions evicted to stay within the caps,
+    tx itself is evicted when it pays the lowest fee rate of all or spends
+    an evicted transaction
+    """
+    def add(self,tx,tx_id = None):
+        tx_id = tx_id or tx.id
+        if tx_id in self._txs:
+            del self[tx_id]
+        self._txs[tx_id] = tx
+        self.size += tx.size
+        for vin in tx.tx_in:
+            if vin.to_spend is not None:
+                self._spent[vin.to_spend] = tx_id
+
+        seq,rate = next(self._counter),feerate(tx)
+        self._seq[tx_id] = seq
+        heapq.heappush(self._best,(-rate,seq,tx_id))
+        heapq.heappush(self._worst,(rate,-seq,tx_id))
+        for watcher in self.watchers:
+            watcher.tx_added(tx)
+
+        evicted = []
+        while self._txs and (len(self._txs) > self.max_txs or self.size > self.max_size):
+            evicted.extend(self._pop_worst())
+        self._compact()
+        return evicted
+
+    def __delitem__(self,tx_id):
+        self._unindex(tx_id)
+        tx = self._txs.pop(tx_id)
+        for watcher in self.watchers:
+            watcher.tx_removed(tx)
+
+    def _unindex(self,tx_id):
+        tx = self._txs[tx_id]
+        self.size -= tx.size
+        del self._seq[tx_id]
+        for vin in tx.tx_in:
+            if self._spent.get(vin.to_spend) == tx_id:
+                del self._spent[vin.to_spend]
+
+    def _is_live(self,seq,tx_id):
+        return self._seq.get(tx_id) == seq
+
+    def _pop_worst(self):
+        while True:
+            _,seq,tx_id = heapq.heappop(self._worst)
+            if self._is_live(-seq,tx_id):
+                return self.remove_with_descendants(tx_id)
+
+    """
+    remove tx_id and every pool transaction built on its outputs,returns
+    the removed transactions
+    """
+    def remove_with_descendants(self,tx_id):
+        removed,queue = [],[tx_id]
+        while queue:
+            tx_id = queue.pop()
+            tx = self._txs.get(tx_id)
+            if tx is None:
+                continue
+            for n in range(len(tx.tx_out)):
+                child = self._spent.get(Pointer(tx_id,n))
+                if child is not None:
+                    queue.append(child)
+            del self[tx_id]
+            removed.append(tx)
+        return removed
+
+    #drop stale heap entries once they outnumber the live ones
+    def _compact(self):
+        if len(self._best) > 2*len(self._txs) + 64:
+            self._best = [e for e in self._best if self._is_live(e[1],e[2])]
+            heapq.heapify(self._best)
+        if len(self._worst) > 2*len(self._txs) + 64:
+            self._worst = [e for e in self._worst if self._is_live(-e[1],e[2])]
+            heapq.heapify(self._worst)
+
+    """
+    the k transactions with the highest fee rate,best first,a transaction
+    waits until its parents in the pool are chosen and comes after them
+    """
+    def top(self,k):
+        popped,txs,chosen,waiting = [],[],set(),[]
+        while self._best and len(txs) < k:
+            entry = heapq.heappop(self._best)
+            if not self._is_live(entry[1],entry[2]):
+                continue
+            popped.append(entry)
+            if not self._parents_chosen(entry[2],chosen):
+                waiting.append(entry[2])
+                continue
+            ready = [entry[2]]
+            while ready and len(txs) < k:
+                tx_id = ready.pop(0)
+                txs.append(self._txs[tx_id])
+                chosen.add(tx_id)
+                now = [w for w in waiting if self._parents_chosen(w,chosen)]
+                waiting = [w for w in waiting if w not in now]
+                ready.extend(now)
+        for entry in popped:
+            heapq.heappush(self._best,entry)
+        return txs
+
+    def _parents_chosen(self,tx_id,chosen):
+        for vin in self._txs[tx_id].tx_in:
+            parent = vin.to_spend and vin.to_spend.tx_id
+            if parent in self._txs and parent not in chosen:
+                return False
+        return True
+
+    def __contains__(self,tx_id):
+        return tx_id in self._txs
+
+    def __iter__(self):
+        return iter(self._txs)
+
+    def __len__(self):
+        return len(self._txs)
+
+    def clear(self):
+        self.size = 0
+        self._txs.clear()
+        self._spent.clear()
+        self._seq.clear()
+        self._best,self._worst = [],[]
+        for watcher in self.watchers:
+            watcher.clear()
+
+    def spender_of(self,pointer):
+        return self._spent.get(pointer)
+
+    """
+    ids of the pool transactions spending any input of tx
+    """
+    def conflicts(self,tx):
+        spent = self._spent
+        return {spent[vin.to_spend] for vin in tx.tx_in if vin.to_spend in spent}
+
+    def __repr__(self):
+        return "MemPool(txs:{0},size:{1})".format(len(self._txs),self.size)
+
+
+"""
+transactions whose inputs are not known yet,indexed by the missing
+pointers so a new transaction only wakes up the orphans waiting on it,
+the oldest orphan makes room once the pool is full and orphans expire
+after Params.ORPHAN_TX_EXPIRE_TIME seconds
+"""
+class OrphanPool(object):
+
+    def __init__(self,max_txs = None,expire_time = None):
+        self.max_txs = max_txs or Params.MAX_ORPHAN_TXS
+        self.expire_time = expire_time or Params.ORPHAN_TX_EXPIRE_TIME
+        self._txs = {}
+        self._waiting = {}
+
+    def add(self,tx,missing):
+        if tx.id in self._txs:
+            return False
+        while len(self._txs) >= self.max_txs:
+            self.remove(next(iter(self._txs)))
+        self._txs[tx.id] = (tx,tuple(missing),time.time() + self.expire_time)
+        for pointer in missing:
+            self._waiting.setdefault(pointer,{})[tx.id] = None
+        return True
+
+    def remove(self,tx_id):
+        tx,missing,_ = self._txs.pop(tx_id)
+        for pointer in missing:
+            waiting = self._waiting.get(pointer)
+            if waiting is not None:
+                waiting.pop(tx_id,None)
+                if not waiting:
+                    del self._waiting[pointer]
+        return tx
+
+    """
+    take out every orphan waiting on pointer
+    """
+    def pop_waiting(self,pointer):
+        tx_ids = self._waiting.pop(pointer,None)
+        if not tx_ids:
+            return []
+        return [self.remove(tx_id) for tx_id in tx_ids if tx_id in self._txs]
+
+    #orphans are kept in arrival order,so expired ones are all at the front
+    def expire(self,now = None):
+        now = now or time.time()
+        expired = []
+        for tx_id,(_,_,deadline) in self._txs.items():
+            if deadline > now:
+                break
+            expired.append(tx_id)
+        return [self.remove(tx_id) for tx_id in expired]
+
+    def get(self,tx_id):
+        entry = self._txs.get(tx_id)
+        return entry[0] if entry else None
+
+    def values(self):
+        return [tx for tx,_,_ in self._txs.values()]
+
+    def __contains__(self,tx_id):
+        return tx_id in self._txs
+
+    def __len__(self):
+        return len(self._txs)
+
+    def __repr__(self):
+        return "OrphanPool(txs:{0})".format(len(self._txs))
@@ -72,3 +72,54 @@ class MerkleTree(object):
 
     
 
+
+
+"""
+merkle root over a list of hashes that changes one leaf at a time,every
+append or update rehashes only the path from that leaf to the root
+"""
+class IncrementalMerkleTree(object):
+
+    def __init__(self,leaves = ()):
+        self.levels = [[]]
+        for leaf in leaves:
+            self.append(leaf)
+
+    @property
+    def leaves(self):
+        return self.levels[0]
+
+    @property
+    def root(self):
+        return self.levels[-1][0] if self.levels[0] else None
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def append(self,leaf):
+        self.levels[0].append(leaf)
+        self._refresh(len(self.levels[0]) - 1)
+
+    def update(self,index,leaf):
+        self.levels[0][index] = leaf
+        self._refresh(index)
+
+    def _refresh(self,index):
+        levels,l = self.levels,0
+        while len(levels[l]) > 1:
+            level = levels[l]
+            if l + 1 == len(levels):
+                levels.append([])
+            up = levels[l + 1]
+            del up[(len(level) + 1)//2:]
+            j = index//2
+            if 2*j + 1 < len(level):
+                val = sha256d(level[2*j] + level[2*j + 1])
+            else:
+                val = level[2*j]
+            if j < len(up):
+                up[j] = val
+            else:
+                up.append(val)
+            index,l = j,l + 1
+        del levels[l + 1:]
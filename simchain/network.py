@@ -4,9 +4,11 @@ import time
 import random
 from .datatype import Vin,Vout,Tx,Block,get_merkle_root_of_txs
 from .logger import logger
-from .peer import Peer,find_utxos_from_block,add_utxos_to_set
+from .peer import Peer,start_chain,start_from_snapshot
+from .snapshot import load_utxo_snapshot
 
 from .consensus import consensus_with_fasttest_minner
+from .vm import SignatureCache
 from .params import Params
 from math import ceil
 from itertools import accumulate
@@ -26,8 +28,11 @@ class Network(object):
         self.winner = []
         self.init_peers_number = nop or Params.INIT_NUMBER_OF_PEERS
         self.init_value = von or Params.INIT_COIN_PER_PEER
+        self.sig_cache = SignatureCache()
         self.create_genesis_block(self.init_peers_number,self.init_value)
         self.time_spent = [0]
+        #hashes of blocks found statistically,they carry no real proof of work
+        self.simulated_blocks = set()
         
         self._is_consensus_peers_chosen = False
         self._not = 0
@@ -39,11 +44,22 @@ class Network(object):
             peer = Peer(coords)
             create_peer(self,peer)
     
-    def add_peer(self):
+    """
+    a new peer syncs from peers[0],or starts from a utxo snapshot file
+    written by Peer.dump_utxo_snapshot when one is given.a damaged snapshot
+    raises SerializationError before the peer joins,one whose tip peers[0]
+    does not know is ignored and the whole chain is synced instead
+    """
+    def add_peer(self,snapshot = None,commitment = None):
+        base = None
+        if snapshot is not None:
+            base = load_utxo_snapshot(snapshot,commitment)
+        
         coords = generate_random_coords()
         peer = Peer(coords)
         create_peer(self,peer)
-        peer.update_blockchain(self.peers[0])
+        if base is None or not start_from_snapshot(peer,base,self.peers[0]):
+            peer.update_blockchain(self.peers[0])
         peer.update_mem_pool(self.peers[0])
         peer.update_utxo_set(self.peers[0])
         logger.info('A new peer joined in --> {0}(pid={1})'.format(peer,peer.pid))
@@ -69,10 +85,8 @@ class Network(object):
         logger.info('A blockchain p2p network created,{0} peers joined'.format(self.nop))
         logger.info('genesis block has been generated')
         
-        utxos = find_utxos_from_block(txs)
         for peer in self.peers:
-            peer.blockchain.append(genesis_block)
-            add_utxos_to_set(peer.utxo_set,utxos)
+            start_chain(peer,genesis_block)
         
             
     def make_random_transactions(self):
@@ -108,9 +122,9 @@ class Network(object):
         if not self._is_consensus_peers_chosen:
             self.choose_random_consensus_peers()
         
-        if meth == 'pow':
+        if meth in ('pow','parallel','race','stat'):
             logger.info('{0} peers are mining'.format(len(self.consensus_peers)))
-            n,nonce,time = consensus_with_fasttest_minner(self.consensus_peers)
+            n,nonce,time = consensus_with_fasttest_minner(self.consensus_peers,meth)
             self.time_spent.append(time)
             self.current_winner = self.consensus_peers[n]
             self.winner.append(self.current_winner)
@@ -122,11 +136,26 @@ class Network(object):
                     ))
             
             block = self.current_winner.package_block(nonce = nonce)
+            if meth == 'stat':
+                self.simulated_blocks.add(block.hash)
             self.current_winner.recieve_block(block)
             self.current_winner.broadcast_block(block)
             
     def draw(self):
         pass
+
+    """
+    opcode name -> [count,secs] over the script machines of all peers,
+    filled when Params.PROFILE_SCRIPTS is set
+    """
+    def script_profile(self):
+        total = {}
+        for peer in self.peers + self.off_peers:
+            for name,(count,secs) in (peer.machine.profile or {}).items():
+                record = total.setdefault(name,[0,0.])
+                record[0] += count
+                record[1] += secs
+        return total
     
     @property
     def time(self):
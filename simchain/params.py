@@ -11,14 +11,50 @@ class Params:
     
     INITIAL_DIFFICULTY_BITS = 18 
     
+    MINING_WORKERS = None #None means one worker per cpu core
+    
+    MINING_CHUNK_SIZE = 1 << 14 #nonces a worker scans between stop checks
+    
+    DEFAULT_HASHRATE = 500000 #hashes/sec of a peer in statistical mining
+    
     FIX_BLOCK_REWARD = 500
     
     MAX_TX_NUMBER_FOR_MINER = 5 
     
+    MAX_TXS_IN_MEM_POOL = 5000
+    
+    MAX_MEM_POOL_SIZE = 1 << 22 #bytes of serialized transactions
+    
+    MAX_ORPHAN_TXS = 100
+    
+    ORPHAN_TX_EXPIRE_TIME = 20 * 60 #secs
+    
+    MAX_ORPHAN_BLOCKS = 50
+    
+    MAX_HEADERS_PER_SYNC = 500 #headers a peer sends for one locator
+    
+    ORPHAN_BLOCK_EXPIRE_TIME = 20 * 60 #secs
+    
     INIT_NUMBER_OF_PEERS = 12
     
     INIT_COIN_PER_PEER = 100000
     
+    MAX_UTXO_LAYERS = 32 #shared utxo layers stacked before they are squashed
+    
+    MAX_SIG_CACHE_SIZE = 100000 #verified inputs remembered network wide
+    
+    VERIFY_WORKERS = 1 #processes batch_verify uses for the inputs of a block
+    
+    PROPAGATION_WORKERS = 1 #threads validating a new block at different peers
+    
+    MAX_SCRIPT_OPS = 201 #non push opcodes one script may run
+    
+    MAX_SCRIPT_SIGOPS = 20 #signature checks one script may run
+    
+    MAX_STACK_SIZE = 1000
+    
+    PROFILE_SCRIPTS = False #count and time every opcode a peer runs
+    
     FIX_FEE_PER_TX = 10
     
     UPPER_BOUND_OF_CONSENSUS_PEERS = 60./100
@@ -1,14 +1,22 @@
 # -*- coding: utf-8 -*-
 
 import random
-from .ecc import VerifyingKey,build_message,convert_pubkey_to_addr
-from .datatype import Pointer,Vin,Vout,UTXO,Tx,Block,get_merkle_root_of_txs
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .ecc import VerifyingKey,build_message,convert_pubkey_to_addr,batch_verify
+from .datatype import Pointer,Vin,Vout,UTXO,Tx,Block,BlockHeader,get_merkle_root_of_txs
 from .params import Params
-from .consensus import mine,caculate_target
+from .consensus import mine,mine_parallel,caculate_target
 from .logger import logger
 from .wallet import Wallet
-from .vm import LittleMachine
+from .vm import LittleMachine,compile_pubkey_script,push_script
 from .merkletree import MerkleTree
+from .utxo import UTXOBase,UTXOSet,base_after_block,base_of_tip
+from .snapshot import dump_utxo_snapshot,load_utxo_snapshot
+from .mempool import MemPool,OrphanPool
+from .template import BlockTemplate
+from .chain import (OrphanBlockPool,BlockIndex,BlockIndexEntry,UndoEntry,
+                    PropagationReport,block_work,has_more_work)
 
 class Peer(object):
     
@@ -19,13 +27,18 @@ class Peer(object):
         self.candidate_block_txs = []
         self.candidate_block = None
         self.blockchain = []
-        self.orphan_block = []
-        self.utxo_set = {}
-        self.mem_pool = {}
-        self.orphan_pool = {}
+        self.block_index = BlockIndex()
+        self.undo_journal = {}
+        self.orphan_block = OrphanBlockPool()
+        self.utxo_set = UTXOSet()
+        self.mem_pool = MemPool()
+        self.block_template = BlockTemplate()
+        self.mem_pool.watchers.append(self.block_template)
+        self.orphan_pool = OrphanPool()
         self.pid = None
         self.fee = Params.FIX_FEE_PER_TX
         self.tx_choice_method = 'whole'
+        self.hashrate = 0
         self.current_tx = None
         self.allow_utxo_from_pool = True
         self.machine = LittleMachine()
@@ -37,10 +50,6 @@ class Peer(object):
         self._is_current_tx_sent = False
         self._delayed_tx = None
         self._delayed_block = None
-        self._utxos_from_vins = None
-        self._pointers_from_vouts = None
-        self._utxos_from_vouts = None
-        self._txs_removed = None
         
         
         
@@ -88,8 +97,8 @@ class Peer(object):
     """
     
     def get_utxo(self):
-        return [utxo for utxo in self.utxo_set.values()
-                if (utxo.vout.to_addr in self.wallet.addrs) and utxo.unspent]
+        return [utxo for utxo in self.utxo_set.utxos_of(self.wallet.addrs)
+                if utxo.unspent]
         
     def get_unconfirmed_utxo(self):
         utxos = self.get_utxo()
@@ -194,11 +203,14 @@ class Peer(object):
     """
     broadcast a transaction 
     """ 
-    def broadcast_block(self,block):
+    def broadcast_block(self,block,workers = None):
         peers = self.network.peers[:]
         peers.remove(self)
-        number = broadcast_winner_block(peers,block)
-        logger.info('{0} received by {1} peers'.format(block,number))
+        report = broadcast_winner_block(peers,block,workers,report = True)
+        logger.info('{0} received by {1} peers in {2:.4f} secs,'
+                    'slowest peer after {3:.4f} secs'.format(
+                            block,report.accepted,report.secs,report.max_latency))
+        return report
                 
                 
     def locate_block(self,block_hash):
@@ -206,7 +218,7 @@ class Peer(object):
    
     
     def recieve_block(self,block):
-        if not self.verify_block(block):
+        if not check_block(self,block):
             return False
         return try_to_add_block(self,block)
     
@@ -243,15 +255,12 @@ class Peer(object):
         if tx.id in self.mem_pool:
             return "unconfirmed"
 
-        tot_height = self.get_height()
-        for i in range(tot_height):
-            txs = self.blockchain[-i-1].txs
-            if tx in txs:
-                break
-            else:
-                return False
+        block_hash = self.block_index.block_of_tx(tx.id)
+        height = locate_block_by_hash(self,block_hash)
+        if not height:
+            return False
 
-        height = tot_height - i
+        txs = self.blockchain[height-1].txs
         idx = txs.index(tx)
         idxs = [tx.id for tx in txs]
         merkle = MerkleTree(idxs)
@@ -269,7 +278,9 @@ class Peer(object):
                 "This peer does not connect to network or online"
                 )
         repeat_log_in(self,self.network)
-        self.update_blockchain()
+        others = [peer for peer in self.network.peers if peer is not self]
+        if others:
+            self.update_blockchain(others[0])
         
                 
     """
@@ -294,7 +305,28 @@ class Peer(object):
 
 
     def update_utxo_set(self,other):
-        self.utxo_set.update(other.utxo_set)
+        mine,theirs = self.utxo_set,other.utxo_set
+        if not mine:
+            self.utxo_set = theirs.copy()
+        elif mine.base.tip == theirs.base.tip:
+            #same tip,same confirmed utxos,only the overlay is taken
+            self.utxo_set = theirs.copy(base = mine.base)
+        else:
+            mine.update(theirs)
+
+    """
+    write the confirmed utxos at the tip to path,returns the commitment
+    """
+    def dump_utxo_snapshot(self,path):
+        return dump_utxo_snapshot(self.utxo_set.base,path)
+
+    """
+    start from a snapshot instead of replaying the chain,other provides
+    the blocks up to the snapshot tip and any after it
+    """
+    def load_utxo_snapshot(self,path,other,commitment = None):
+        base = load_utxo_snapshot(path,commitment)
+        return start_from_snapshot(self,base,other)
               
     ############################################################
     # peer as recorder
@@ -305,11 +337,21 @@ class Peer(object):
     """
     
     def create_candidate_block(self):
-        self.choose_tx_candidates()
-        txs = self.candidate_block_txs
-        value = self.get_block_reward() + self.calculate_fees(txs)
-        coinbase = self.create_coinbase(value)
-        txs = [coinbase]+txs
+        merkle_root_hash = None
+        if self.tx_choice_method == 'whole':
+            #the block template already mirrors the whole memory pool
+            if not self.mem_pool:
+                self.update_mem_pool(self.network.peers[0])
+            value = self.get_block_reward() + self.block_template.fees
+            coinbase = self.create_coinbase(value)
+            txs,merkle_root_hash = self.block_template.refresh(coinbase)
+            self.candidate_block_txs = txs[1:]
+        else:
+            self.choose_tx_candidates()
+            txs = self.candidate_block_txs
+            value = self.get_block_reward() + self.calculate_fees(txs)
+            coinbase = self.create_coinbase(value)
+            txs = [coinbase]+txs
         
         prev_block_hash = self.blockchain[-1].hash
         bits = Params.INITIAL_DIFFICULTY_BITS 
@@ -318,13 +360,14 @@ class Peer(object):
                                      timestamp = self.network.time[-1],
                                      bits = bits, 
                                      nonce = 0,
-                                     txs = txs or [])
+                                     txs = txs or [],
+                                     merkle_root_hash = merkle_root_hash)
         
         self._is_block_candidate_created = True
         
     
     '''
-    pow used right now
+    pow used right now,'parallel' splits the nonce search over cpu cores
     '''        
     def consensus(self,meth = 'pow'):
         if not self._is_block_candidate_created:
@@ -333,6 +376,9 @@ class Peer(object):
             
         if meth == 'pow':
             return mine(self.candidate_block)
+        
+        if meth == 'parallel':
+            return mine_parallel(self.candidate_block)
 
     """
     if this is a recorder peer, we have package the candidate block
@@ -354,6 +400,11 @@ class Peer(object):
             if not self.mem_pool:
                 self.update_mem_pool(self.network.peers[0])
             self.candidate_block_txs = choose_raondom_txs_from_pool(self.mem_pool)
+        
+        elif self.tx_choice_method == 'fee':
+            if not self.mem_pool:
+                self.update_mem_pool(self.network.peers[0])
+            self.candidate_block_txs = choose_top_fee_txs_from_pool(self.mem_pool)
 
     """
     get transactions for candidate block
@@ -381,24 +432,137 @@ def repeat_log_in(peer,net):
 def log_out(peer,net):
     net.peers.remove(peer)
     net.off_peers.append(peer)
-    peer.mem_pool = []
+    peer.mem_pool.clear()
 
 def update_chain(peer,other):
-    other_height = other.get_height()
-    height = peer.get_height()
-    if other_height > height:
-        peer.blockchain = []
-        for block in other.blockchain:
-            peer.blockchain.append(block)
-        return True
-    return False
+    return sync_chain(peer,other) > 0
+
+
+# =============================================================================
+#chain synchronization,headers first
+    
+def start_chain(peer,genesis_block):
+    append_block_to_chain(peer,genesis_block)
+    peer.utxo_set = UTXOSet(base_after_block(UTXOBase(),genesis_block))
+
+#blocks below the snapshot tip have no undo entries,so no reorg goes past it
+def start_from_snapshot(peer,base,other):
+    height = locate_block_by_hash(other,base.tip)
+    if not height:
+        logger.info('{0}(pid={1}) does not know snapshot tip {2}'.format(other,other.pid,base.tip))
+        return False
+    
+    peer.blockchain = []
+    peer.block_index = BlockIndex()
+    peer.undo_journal = {}
+    for block in other.blockchain[:height]:
+        append_block_to_chain(peer,block)
+    peer.utxo_set = UTXOSet(base)
+    sync_chain(peer,other)
+    return True
+
+"""
+hashes of the main chain,one per block near the tip and exponentially
+sparser towards the genesis block,which always ends the list
+"""
+def block_locator(peer):
+    hashes,height,step = [],peer.get_height(),1
+    while height > 0:
+        hashes.append(peer.blockchain[height-1].hash)
+        if len(hashes) >= 10:
+            step *= 2
+        height -= step
+    genesis_hash = peer.blockchain[0].hash
+    if hashes and hashes[-1] != genesis_hash:
+        hashes.append(genesis_hash)
+    return hashes
+
+#height of the newest locator block on the peer's main chain
+def find_fork_height(peer,locator):
+    for block_hash in locator:
+        height = locate_block_by_hash(peer,block_hash)
+        if height:
+            return height
+    return 0
+
+"""
+headers of the main chain blocks after the fork point with locator,what a
+peer answers to a getheaders request
+"""
+def get_headers(peer,locator,max_headers = None):
+    max_headers = max_headers or Params.MAX_HEADERS_PER_SYNC
+    start = find_fork_height(peer,locator)
+    return [BlockHeader.from_block(block)
+            for block in peer.blockchain[start:start+max_headers]]
+
+def get_blocks(peer,block_hashes):
+    index = peer.block_index
+    return [index.get(block_hash).block for block_hash in block_hashes
+            if block_hash in index]
+
+"""
+check that headers link up to a known block and carry their proof of work,
+returns the index entry their last header would get or None
+"""
+def verify_headers(peer,headers):
+    prev = peer.block_index.get(headers[0].prev_block_hash)
+    if prev is None:
+        return None
+    
+    prev_hash,work = prev.block.hash,prev.work
+    for header in headers:
+        if header.prev_block_hash != prev_hash:
+            return None
+        if not check_pow(peer,header):
+            return None
+        prev_hash,work = header.hash,work + block_work(header.bits)
+    return BlockIndexEntry(headers[-1],prev.height + len(headers),work)
+
+"""
+catch up with other: find the common ancestor from a block locator,take
+its headers,and fetch only the bodies of blocks the peer does not have,
+returns how many blocks were fetched
+"""
+def sync_chain(peer,other):
+    if not other.blockchain:
+        return 0
+    if not peer.blockchain:
+        start_chain(peer,other.blockchain[0])
+    
+    fetched = 0
+    while True:
+        headers = get_headers(other,block_locator(peer))
+        if not headers:
+            break
+        entry = verify_headers(peer,headers)
+        if entry is None:
+            logger.info('{0}(pid={1}) got invalid headers from {2}'.format(peer,peer.pid,other))
+            break
+        tip = peer.block_index.get(peer.blockchain[-1].hash)
+        if not has_more_work(entry,tip):
+            break
+        
+        missing = [header.hash for header in headers
+                   if header.hash not in peer.block_index]
+        blocks = get_blocks(other,missing)
+        for block in blocks:
+            accept_block(peer,block)
+        fetched += len(blocks)
+        if peer.blockchain[-1].hash != entry.block.hash:
+            logger.info('{0}(pid={1}) stopped syncing with {2}'.format(peer,peer.pid,other))
+            break
+        if len(headers) < Params.MAX_HEADERS_PER_SYNC:
+            break
+    
+    logger.info('{0}(pid={1}) fetched {2} blocks from {3}'.format(peer,peer.pid,fetched,other))
+    return fetched
     
 
 def update_pool(peer,pool):
-    a,b = set(peer.mem_pool),set(pool)
-    for tx_id in (b-a):
-        tx = pool.get(tx_id)
-        peer.mem_pool[tx_id] = tx
+    #in pool order,parents go in before their children
+    for tx_id,tx in list(pool.items()):
+        if tx_id not in peer.mem_pool:
+            insert_tx_to_mem_pool(peer,tx)
     
     if peer._delayed_tx:
         fill_mem_pool(peer)
@@ -413,7 +577,8 @@ def update_pool(peer,pool):
 # =============================================================================         
 #create transactions
 def create_normal_tx(peer,to_addr,value) :
-    utxos,balance = peer.get_utxo(),peer.get_balance()
+    utxos = peer.get_utxo()
+    balance = sum(utxo.vout.value for utxo in utxos)
     fee,wallet = peer.fee,peer.wallet
     
     tx_in,tx_out = [],[]
@@ -434,6 +599,7 @@ def create_normal_tx(peer,to_addr,value) :
         tx_out +=[Vout(to_addr,value-fee),Vout(my_addr,need_to_spend-value)]
     else:
         tx_out += [Vout(to_addr,value-fee)]
+    tx_out = tuple(tx_out)
             
             
     for utxo in utxos[:n]:
@@ -461,6 +627,9 @@ def choose_raondom_txs_from_pool(pool):
 def choose_whole_txs_from_pool(pool):
     return list(pool.values())
 
+def choose_top_fee_txs_from_pool(pool):
+    return pool.top(Params.MAX_TX_NUMBER_FOR_MINER)
+
 # =============================================================================
 #broadcast transactions  
 # =============================================================================
@@ -494,26 +663,65 @@ def broadcast_tx(peers,current_tx):
     return number_of_verification
 
 
+#orphans are retried as soon as their inputs show up,here they only expire
 def check_orphan_tx_from_pool(peer):
-    copy_pool = peer.orphan_pool.copy()
-    for tx in copy_pool.values():
-        if not verify_tx(tx,peer.mem_pool):
-            return False
-        add_tx_to_mem_pool(peer,tx)
-        del peer.orphan_pool[tx.id]
+    expired = peer.orphan_pool.expire()
+    if expired:
+        logger.info('{0}(pid={1}) dropped {2} expired orphan transactions'.format(
+                peer,peer.pid,len(expired)))
     return True
+
+"""
+retry only the orphans waiting on outputs of txs,and in turn the orphans
+waiting on the ones accepted
+"""
+def accept_orphan_txs(peer,txs):
+    queue = list(txs)
+    while queue and peer.orphan_pool:
+        tx = queue.pop()
+        for i in range(len(tx.tx_out)):
+            for orphan in peer.orphan_pool.pop_waiting(Pointer(tx.id,i)):
+                if verify_tx(peer,orphan,peer.mem_pool):
+                    insert_tx_to_mem_pool(peer,orphan)
+                    queue.append(orphan)
             
 # =============================================================================
 #broadcast_block
 # =============================================================================
     
-def broadcast_winner_block(peers,block): 
-    number_of_verification = 0
-    for peer in peers: 
-        if peer.verify_block(block):
-            try_to_add_block(peer,block)
-            number_of_verification += 1
+"""
+workers > 1 validates the block at the peers in parallel threads,then
+connects it at each peer in order,so peers end up as with one worker.
+the latency of a peer is when its own validation finished
+"""
+def broadcast_winner_block(peers,block,workers = None,report = False): 
+    workers = workers or Params.PROPAGATION_WORKERS
+    number_of_verification,latencies = 0,[]
+    start = time.time()
+    if workers > 1:
+        #threads share the GIL,so the signatures are checked once up front
+        #and every thread only finds them in the shared cache
+        for peer in peers:
+            if peer.blockchain and peer.blockchain[-1].hash == block.prev_block_hash:
+                batch_verify_inputs(peer,block.txs[1:])
+                break
+        def check(peer):
+            valid = check_block(peer,block)
+            return valid,time.time() - start
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            checked = list(executor.map(check,peers))
+        for peer,(valid,latency) in zip(peers,checked):
+            if valid and try_to_add_block(peer,block):
+                number_of_verification += 1
+            latencies.append(latency)
+    else:
+        for peer in peers: 
+            if peer.recieve_block(block):
+                number_of_verification += 1
+            latencies.append(time.time() - start)
     
+    if report:
+        return PropagationReport(number_of_verification,time.time() - start,latencies)
     return number_of_verification
     
         
@@ -586,6 +794,13 @@ def sign_utxo_from_tx(utxo_set,tx):
         utxo = utxo._replace(unspent = False)
         utxo_set[pointer] = utxo
 
+#the inputs of a tx that left the pool unconfirmed can be spent again
+def unsign_utxo_from_tx(utxo_set,tx):
+    for vin in tx.tx_in:
+        utxo = utxo_set.get(vin.to_spend)
+        if utxo is not None and not utxo.unspent:
+            utxo_set[vin.to_spend] = utxo._replace(unspent = True)
+
                     
 def add_utxos_from_tx_to_set(utxo_set,tx):
     utxos = find_utxos_from_tx(tx)
@@ -617,7 +832,7 @@ def remove_utxos_from_set(utxo_set,pointers):
 #verify transaction
 # =============================================================================
         
-def verify_tx(peer,tx,pool = {}):
+def verify_tx(peer,tx,pool = {},block_utxos = None):
     
     if not verify_tx_basics(tx):
         return False
@@ -628,17 +843,22 @@ def verify_tx(peer,tx,pool = {}):
     
     available_value = 0
 
-    for vin in tx.tx_in:
+    for i,vin in enumerate(tx.tx_in):
         utxo = peer.utxo_set.get(vin.to_spend)
+        if not utxo and block_utxos:
+            utxo = block_utxos.get(vin.to_spend)
         
         if not utxo:
             logger.info(
                     '{0}(pid={1}) find a orphan transaction {2}'.format(peer,peer.pid,tx)
                     )
-            peer.orphan_pool[tx.id] = tx
+            missing = [vin.to_spend for vin in tx.tx_in
+                       if vin.to_spend not in peer.utxo_set
+                       and vin.to_spend not in (block_utxos or ())]
+            peer.orphan_pool.add(tx,missing)
             return False
 
-        if not verify_signature(peer,vin,utxo,tx.tx_out):
+        if not verify_signature(peer,vin,utxo,tx.tx_out,(tx.id,i,utxo.pubkey_script)):
             logger.info('singature does not math for {0}'.format(tx))
             return False
     
@@ -652,14 +872,22 @@ def verify_tx(peer,tx,pool = {}):
 
     return True
 
-def verify_signature(peer,vin,utxo,tx_out):
+#scripts that passed at any peer of the network are not run again
+def verify_signature(peer,vin,utxo,tx_out,cache_key = None):
+    cache = peer.network.sig_cache if peer.network is not None else None
+    if cache is not None and cache_key is not None and cache.lookup(cache_key):
+        return True
+    
     script = check_script_for_vin(vin,utxo,peer.key_base_len)
     if not script:
         return False
     string = str(vin.to_spend) + str(vin.pubkey) + str(tx_out)
     message = build_message(string)
     peer.machine.set_script(script,message)
-    return peer.machine.run()
+    result = peer.machine.run()
+    if result and cache is not None and cache_key is not None:
+        cache.add(cache_key)
+    return result
 
 
 def check_script_for_vin(vin,utxo,baselen):
@@ -667,13 +895,12 @@ def check_script_for_vin(vin,utxo,baselen):
     double,fourfold = int(baselen*2),int(baselen*4)
     if len(sig_script) != fourfold:
         return False
-    sig_scrip = [sig_script[:double],sig_script[double:]]
     try:
-        pubkey_script = pubkey_script.split(' ')
+        pubkey_script = compile_pubkey_script(pubkey_script)
     except Exception:
         return False
 
-    return sig_scrip+pubkey_script
+    return push_script(sig_script[:double],sig_script[double:]) + pubkey_script
 
 
 def verify_signature_for_vin(vin,utxo,tx_out):
@@ -706,6 +933,8 @@ def verify_tx_basics(tx):
 def double_payment(pool,tx):
     if tx.id in pool:
         return True
+    if isinstance(pool,MemPool):
+        return pool.conflicts(tx)
     a = {vin.to_spend for vin in tx.tx_in}
     b = {vin.to_spend for tx in pool.values() for vin in tx.tx_in}
     return a.intersection(b)
@@ -722,15 +951,30 @@ def verify_coinbase(tx,reward):
 # =============================================================================
 #verify block
 # =============================================================================
+
+"""
+proof of work of a header,blocks the network found statistically carry
+none and are accepted as they are
+"""
+def check_pow(peer,header):
+    if peer.network is not None and header.hash in peer.network.simulated_blocks:
+        return True
+    return int(header.hash, 16) <= caculate_target(header.bits)
     
-def verify_winner_block(peer,block):
+def verify_block_header(peer,block):
 
     if not isinstance(block,Block):
         return False
     
-    if int(block.hash, 16) > caculate_target(block.bits):
+    if not check_pow(peer,block):
         logger.info('{0} wrong answer'.format(block))
         return False
+    return True
+    
+def verify_winner_block(peer,block):
+
+    if not verify_block_header(peer,block):
+        return False
     
     txs = block.txs
     if not isinstance(txs,list) and \
@@ -742,6 +986,11 @@ def verify_winner_block(peer,block):
         logger.info('no enough txs for txs {0}'.format(block))
         return False
 
+    #the header root is taken as given when the block is built
+    if get_merkle_root_of_txs(txs) != block.merkle_root_hash:
+        logger.info('{0} merkle root does not match its txs'.format(block))
+        return False
+
     block_txs = txs[1:]
     rewards = peer.get_block_reward()+peer.calculate_fees(block_txs)
     if not verify_coinbase(block.txs[0],rewards):
@@ -753,11 +1002,64 @@ def verify_winner_block(peer,block):
         logger.info('double payment in {0}'.format(block))
         return False
 
+    if not batch_verify_inputs(peer,block_txs):
+        logger.info('bad signature in {0}'.format(block))
+        return False
+
+    #outputs of earlier txs in the block can be spent by later ones
+    created = {}
     for tx in block_txs:
-        if not verify_tx(peer,tx):
+        if not verify_tx(peer,tx,block_utxos = created):
             return False
+        for utxo in find_utxos_from_tx(tx):
+            created[utxo.pointer] = utxo
     return True
 
+"""
+check the signatures of all standard inputs of txs with one batch_verify
+call,the good ones go into the network signature cache where verify_tx
+finds them
+"""
+def batch_verify_inputs(peer,txs):
+    cache = peer.network.sig_cache if peer.network is not None else None
+    if cache is None:
+        return True
+    
+    triples,keys,created = [],[],{}
+    for tx in txs:
+        for i,vin in enumerate(tx.tx_in):
+            utxo = peer.utxo_set.get(vin.to_spend) or created.get(vin.to_spend)
+            if utxo is None:
+                continue
+            key = (tx.id,i,utxo.pubkey_script)
+            if key in cache or not is_standard_input(vin,utxo,peer.key_base_len):
+                continue
+            string = str(vin.to_spend) + str(vin.pubkey) + str(tx.tx_out)
+            triples.append((vin.pubkey,vin.signature,build_message(string)))
+            keys.append(key)
+        for utxo in find_utxos_from_tx(tx):
+            created[utxo.pointer] = utxo
+    if not triples:
+        return True
+    
+    start = time.time()
+    results = batch_verify(triples,Params.VERIFY_WORKERS)
+    logger.info('{0}(pid={1}) verified {2} signatures in {3:.4f} secs'.format(
+            peer,peer.pid,len(triples),time.time() - start))
+    for key,ok in zip(keys,results):
+        if ok:
+            cache.add(key)
+    return all(results)
+
+#pay to pubkey hash with a signature and a key of the expected size
+def is_standard_input(vin,utxo,baselen):
+    double = int(baselen*2)
+    if not isinstance(vin.signature,bytes) or not isinstance(vin.pubkey,bytes):
+        return False
+    if len(vin.signature) != double or len(vin.pubkey) != double:
+        return False
+    return convert_pubkey_to_addr(vin.pubkey) == utxo.vout.to_addr
+
 def double_payment_in_block_txs(txs):
     a = {vin.to_spend for tx in txs for vin in tx.tx_in}
     b = [vin.to_spend for tx in txs for vin in tx.tx_in]
@@ -768,63 +1070,182 @@ def double_payment_in_block_txs(txs):
 #try to recieve a block
 # =============================================================================
     
+#height of block_hash if it is on the peer's chain
 def locate_block_by_hash(peer,block_hash):
-    for height,block in enumerate(peer.blockchain):
-        if block.hash == block_hash:
-            return height+1
-    return None
-        
-def try_to_add_block(peer,block):  
-    prev_hash = block.prev_block_hash                                                  
-    height = locate_block_by_hash(peer,prev_hash)
-    if not height:
+    entry = peer.block_index.get(block_hash)
+    if entry is None or entry.height > len(peer.blockchain):
+        return None
+    if peer.blockchain[entry.height-1].hash != block_hash:
+        return None
+    return entry.height
+
+#blocks stay in the block tree when they leave the main chain
+def append_block_to_chain(peer,block):
+    peer.blockchain.append(block)
+    peer.block_index.add(block)
+    peer.block_index.index_txs(block)
+
+def pop_block_from_chain(peer):
+    block = peer.blockchain.pop()
+    peer.block_index.unindex_txs(block)
+    return block
+        
+def try_to_add_block(peer,block):
+    added = add_block_to_chain(peer,block)
+    if peer.orphan_block and block.hash in peer.block_index:
+        check_orphan_block(peer,block)
+    return added
+
+#txs of a block off the tip are checked when its branch is connected
+def check_block(peer,block):
+    if peer.blockchain and block.prev_block_hash != peer.blockchain[-1].hash:
+        return verify_block_header(peer,block)
+    return peer.verify_block(block)
+
+def accept_block(peer,block):
+    if block.prev_block_hash == peer.blockchain[-1].hash:
+        valid = verify_winner_block(peer,block)
+    else:
+        valid = verify_block_header(peer,block)
+    return valid and add_block_to_chain(peer,block)
+
+"""
+put block into the block tree and move to the branch with the most work,
+returns True when the main chain changed
+"""
+def add_block_to_chain(peer,block):  
+    index = peer.block_index
+    if block.hash in index:
+        return False
+    if block.hash in index.invalid or block.prev_block_hash in index.invalid:
+        logger.info('{0}(pid={1}) rejects {2} on an invalid branch'.format(peer,peer.pid,block))
+        index.invalid.add(block.hash)
+        return False
+    if block.prev_block_hash not in index:
         logger.info('{0}(pid={1} find a orphan {2})'.format(peer,peer.pid,block))
-        peer.orphan_block.append(block)
+        peer.orphan_block.add(block)
         return False
     
-    if height == peer.get_height():
-        peer.blockchain.append(block)
-        recieve_new_prev_hash_block(peer,block.txs)
+    entry = index.add(block)
+    tip = index.get(peer.blockchain[-1].hash)
+    if block.prev_block_hash == tip.block.hash:
+        connect_block(peer,block)
         return True
     
-    elif height == peer.get_height()-1:
-        b1,b2 = peer.blockchain[-1],block
-        a,b = int(b1.hash,16),int(b2.hash,16)
-        if a < b:
+    if not has_more_work(entry,tip):
+        logger.info('{0}(pid={1}) keeps side branch {2}'.format(peer,peer.pid,block))
+        return False
+    return switch_to_branch(peer,entry)
+
+"""
+reorganize onto the branch ending at entry,its txs are verified as its
+blocks are connected and the old chain comes back if one of them fails
+"""
+def switch_to_branch(peer,entry):
+    index,branch = peer.block_index,[]
+    while not locate_block_by_hash(peer,entry.block.hash):
+        branch.append(entry.block)
+        parent = index.get(entry.parent_hash)
+        if parent is None:
+            logger.info('{0}(pid={1}) branch of {2} is broken'.format(peer,peer.pid,branch[0]))
+            index.remove_invalid(branch[-1].hash)
             return False
-        else:
-            peer.blookchian.pop()
-            peer.blockchain.append(block)
-            recieve_exist_prev_hash_block(peer,block.txs)
-    else:
+        entry = parent
+    fork_height = entry.height
+    if not can_roll_back_to(peer,fork_height):
+        logger.info('{0}(pid={1}) can not reorganize below its snapshot for {2}'.format(
+                peer,peer.pid,branch[0]))
         return False
+
+    disconnected = reorganize(peer,fork_height,[])
+    for block in reversed(branch):
+        if not verify_winner_block(peer,block):
+            logger.info('{0}(pid={1}) invalid branch at {2}'.format(peer,peer.pid,block))
+            index.remove_invalid(block.hash)
+            reorganize(peer,fork_height,reversed(disconnected))
+            return False
+        connect_block(peer,block)
+    return True
     
-def check_orphan_block(peer):
-    pass
+"""
+connect the orphans waiting on block,then the ones waiting on those
+"""
+def check_orphan_block(peer,block):
+    queue = [block]
+    while queue and peer.orphan_block:
+        parent = queue.pop()
+        for child in peer.orphan_block.pop_children(parent.hash):
+            accept_block(peer,child)
+            if child.hash in peer.block_index:
+                logger.info('{0}(pid={1}) connected orphan {2}'.format(peer,peer.pid,child))
+                queue.append(child)
+
+def connect_block(peer,block):
+    append_block_to_chain(peer,block)
+    peer.undo_journal[block.hash] = recieve_new_prev_hash_block(peer,block.txs)
+    rebase_utxo_set(peer,block)
 
 def recieve_new_prev_hash_block(peer,txs):
     utxo_set,pool = peer.utxo_set,peer.mem_pool
     allow_utxo_from_pool = peer.allow_utxo_from_pool
-    peer._utxos_from_vins = remove_spent_utxo_from_txs(utxo_set,txs)
-    peer._pointers_from_vouts,peer._utxos_from_vouts = confirm_utxos_from_txs(
+    spent = remove_spent_utxo_from_txs(utxo_set,txs)
+    created,pool_utxos = confirm_utxos_from_txs(
             utxo_set,txs,allow_utxo_from_pool
             )
-    peer._txs_removed = remove_txs_from_pool(pool,txs)
+    txs_removed = remove_txs_from_pool(pool,txs)
+    if peer.orphan_pool:
+        accept_orphan_txs(peer,txs)
+    return UndoEntry(spent,created,pool_utxos,txs_removed)
     
     
-def recieve_exist_prev_hash_block(peer,txs):
-    roll_back(peer)
-    recieve_new_prev_hash_block(peer,txs)
+#move the peer onto the shared confirmed utxos of its new tip
+def rebase_utxo_set(peer,block):
+    base = base_after_block(peer.utxo_set.base,block)
+    if base is not None:
+        peer.utxo_set.rebase(base)
 
+"""
+disconnect the tip block and undo what connecting it changed,the cost
+depends on the size of the block and not on the length of the chain
+"""
 def roll_back(peer):
-    peer.mem_pool.update(peer._txs_removed)
-    add_utxos_to_set(peer.utxo_set,peer._utxos_from_vins)
-    remove_utxos_from_set(peer.utxo_set,peer._pointers_from_vouts)
-    add_utxos_to_set(peer.utxo_set,peer._utxos_from_vouts)
-    peer._utxos_from_vins = []
-    peer._pointers_from_vouts = []
-    peer._utxos_from_vouts = []
-    peer._txs_removed = {}
+    if not can_roll_back_to(peer,peer.get_height() - 1):
+        logger.info('{0}(pid={1}) has no undo data for its tip'.format(peer,peer.pid))
+        return None
+    block = pop_block_from_chain(peer)
+    undo = peer.undo_journal.pop(block.hash)
+    add_utxos_to_set(peer.utxo_set,undo.spent)
+    remove_utxos_from_set(peer.utxo_set,undo.created)
+    add_utxos_to_set(peer.utxo_set,undo.pool_utxos)
+    base = base_of_tip(block.prev_block_hash)
+    if base is not None:
+        peer.utxo_set.rebase(base)
+    for tx in undo.txs_removed.values():
+        insert_tx_to_mem_pool(peer,tx)
+    return block
+
+"""
+blocks above fork_height can only be disconnected with their undo data,
+which blocks loaded from a utxo snapshot do not have
+"""
+def can_roll_back_to(peer,fork_height):
+    return all(block.hash in peer.undo_journal
+               for block in peer.blockchain[max(fork_height,0):])
+
+"""
+roll back to the block at fork_height and connect blocks on top of it,
+returns the blocks that were disconnected,tip first
+"""
+def reorganize(peer,fork_height,blocks):
+    disconnected = []
+    while peer.get_height() > fork_height:
+        block = roll_back(peer)
+        if block is None:
+            break
+        disconnected.append(block)
+    for block in blocks:
+        connect_block(peer,block)
+    return disconnected
     
 def compare_block_by_hash(a,b):
     pass
@@ -859,9 +1280,17 @@ def add_txs_to_pool(pool,txs):
         pool[tx.id] = tx
            
 def add_tx_to_mem_pool(peer,tx):
-    peer.mem_pool[tx.id] = tx
+    insert_tx_to_mem_pool(peer,tx)
+    if peer.orphan_pool:
+        accept_orphan_txs(peer,[tx])
+
+def insert_tx_to_mem_pool(peer,tx):
+    evicted = peer.mem_pool.add(tx)
     if peer.allow_utxo_from_pool:
         add_utxos_from_tx_to_set(peer.utxo_set,tx)
+        remove_utxos_from_set(peer.utxo_set,find_vout_pointer_from_txs(evicted))
+    for tx in evicted:
+        unsign_utxo_from_tx(peer.utxo_set,tx)
 
 def calculate_next_block_bits(local_time,prev_height,prev_bits):
     flag = (prev_height + 1) % Params.TOTAL_BLOCKS
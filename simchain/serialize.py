@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Primitives of the binary wire format.
+Writers return bytes, readers take a buffer (bytes or memoryview) and an
+offset and return (value,new_offset), so a whole block can be parsed from
+one memoryview without slicing copies of it.
+"""
+
+import struct
+
+SERIAL_VERSION = 2
+
+HASH_LEN = 32
+NULL_HASH = b'\x00'*HASH_LEN
+
+_TAG_NONE,_TAG_BYTES,_TAG_STR,_TAG_INT,_TAG_FLOAT = range(5)
+
+_double = struct.Struct('<d')
+_uint16 = struct.Struct('<H')
+_uint32 = struct.Struct('<I')
+_uint64 = struct.Struct('<Q')
+
+
+class SerializationError(ValueError):
+    pass
+
+
+#readers check the buffer holds n more bytes before unpacking them
+def _need(buf,offset,n,what):
+    if offset + n > len(buf):
+        raise SerializationError('truncated {0}'.format(what))
+
+
+def write_varint(n):
+    if n < 0:
+        raise SerializationError('varint must be non-negative: {0}'.format(n))
+    if n < 0xfd:
+        return bytes((n,))
+    if n <= 0xffff:
+        return b'\xfd' + _uint16.pack(n)
+    if n <= 0xffffffff:
+        return b'\xfe' + _uint32.pack(n)
+    if n <= 0xffffffffffffffff:
+        return b'\xff' + _uint64.pack(n)
+    raise SerializationError('varint out of range: {0}'.format(n))
+
+def read_varint(buf,offset):
+    _need(buf,offset,1,'varint')
+    prefix = buf[offset]
+    if prefix < 0xfd:
+        return prefix,offset+1
+    if prefix == 0xfd:
+        _need(buf,offset,3,'varint')
+        return _uint16.unpack_from(buf,offset+1)[0],offset+3
+    if prefix == 0xfe:
+        _need(buf,offset,5,'varint')
+        return _uint32.unpack_from(buf,offset+1)[0],offset+5
+    _need(buf,offset,9,'varint')
+    return _uint64.unpack_from(buf,offset+1)[0],offset+9
+
+
+def write_hash(hex_hash):
+    if hex_hash is None:
+        return NULL_HASH
+    raw = bytes.fromhex(hex_hash)
+    if len(raw) != HASH_LEN:
+        raise SerializationError('hash must be {0} bytes'.format(HASH_LEN))
+    return raw
+
+def read_hash(buf,offset):
+    end = offset + HASH_LEN
+    raw = bytes(buf[offset:end])
+    if len(raw) != HASH_LEN:
+        raise SerializationError('truncated hash')
+    if raw == NULL_HASH:
+        return None,end
+    return raw.hex(),end
+
+
+def write_bytes(b):
+    return write_varint(len(b)) + b
+
+def read_bytes(buf,offset):
+    n,offset = read_varint(buf,offset)
+    end = offset + n
+    if end > len(buf):
+        raise SerializationError('truncated bytes')
+    return bytes(buf[offset:end]),end
+
+def write_str(s):
+    return write_bytes(s.encode())
+
+def read_str(buf,offset):
+    b,offset = read_bytes(buf,offset)
+    return b.decode(),offset
+
+
+def read_uint8(buf,offset):
+    _need(buf,offset,1,'uint8')
+    return buf[offset],offset+1
+
+
+def write_uint64(n):
+    return _uint64.pack(n)
+
+def read_uint64(buf,offset):
+    _need(buf,offset,8,'uint64')
+    return _uint64.unpack_from(buf,offset)[0],offset+8
+
+
+#signatures,pubkeys,timestamps,values and fees are loosely typed in
+#simchain,so they are written with a one byte type tag
+def write_value(v):
+    if v is None:
+        return bytes((_TAG_NONE,))
+    if isinstance(v,bytes):
+        return bytes((_TAG_BYTES,)) + write_bytes(v)
+    if isinstance(v,str):
+        return bytes((_TAG_STR,)) + write_str(v)
+    if isinstance(v,bool):
+        raise SerializationError('unsupported value type: bool')
+    if isinstance(v,int):
+        zigzag = (v << 1) if v >= 0 else ((-v << 1) - 1)
+        return bytes((_TAG_INT,)) + write_varint(zigzag)
+    if isinstance(v,float):
+        return bytes((_TAG_FLOAT,)) + _double.pack(v)
+    raise SerializationError('unsupported value type: {0}'.format(type(v)))
+
+def read_value(buf,offset):
+    _need(buf,offset,1,'value')
+    tag = buf[offset]
+    offset += 1
+    if tag == _TAG_NONE:
+        return None,offset
+    if tag == _TAG_BYTES:
+        return read_bytes(buf,offset)
+    if tag == _TAG_STR:
+        return read_str(buf,offset)
+    if tag == _TAG_INT:
+        zigzag,offset = read_varint(buf,offset)
+        v = (zigzag >> 1) if not zigzag & 1 else -((zigzag + 1) >> 1)
+        return v,offset
+    if tag == _TAG_FLOAT:
+        _need(buf,offset,8,'float')
+        return _double.unpack_from(buf,offset)[0],offset+8
+    raise SerializationError('unknown value tag: {0}'.format(tag))
+
+
+def read_version(buf,offset):
+    version,offset = read_uint8(buf,offset)
+    if version != SERIAL_VERSION:
+        raise SerializationError('unsupported serialization version: {0}'.format(version))
+    return version,offset
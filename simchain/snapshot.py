@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+UTXO snapshots.
+
+A snapshot holds the confirmed utxos at one chain tip:
+
+    magic | version | tip hash | count | utxo * count | commitment
+
+The commitment is the double sha256 of everything before it. A snapshot
+is read through mmap and its commitment is checked before the utxos are
+parsed, so a new peer can start from it without replaying the chain.
+"""
+
+import mmap
+from hashlib import sha256
+from .datatype import UTXO
+from .serialize import (SERIAL_VERSION,HASH_LEN,SerializationError,
+                        write_varint,read_varint,write_hash,read_hash,
+                        read_version)
+from .utxo import UTXOBase
+
+SNAPSHOT_MAGIC = b'SCUTXO'
+
+
+#sha256d over a buffer,memoryviews of the mapped file are hashed in place
+def _commitment(buf):
+    return sha256(sha256(buf).digest()).hexdigest()
+
+
+def dump_utxo_snapshot(base,path):
+    utxos = [utxo for _,utxo in base.items()]
+    parts = [SNAPSHOT_MAGIC,
+             bytes((SERIAL_VERSION,)),
+             write_hash(base.tip),
+             write_varint(len(utxos))]
+    parts += [utxo.serialize() for utxo in utxos]
+    body = b''.join(parts)
+    commitment = _commitment(body)
+    with open(path,'wb') as f:
+        f.write(body)
+        f.write(bytes.fromhex(commitment))
+    return commitment
+
+
+"""
+read a snapshot into a UTXOBase,raises SerializationError when the file
+is damaged or does not match the expected commitment
+"""
+def load_utxo_snapshot(path,commitment = None):
+    with open(path,'rb') as f:
+        #an empty file can not be mapped
+        if not f.seek(0,2):
+            raise SerializationError('not a utxo snapshot')
+        f.seek(0)
+        with mmap.mmap(f.fileno(),0,access = mmap.ACCESS_READ) as m:
+            buf = memoryview(m)
+            try:
+                return _read_snapshot(buf,commitment)
+            finally:
+                buf.release()
+
+def _read_snapshot(buf,commitment):
+    end = len(buf) - HASH_LEN
+    if end < len(SNAPSHOT_MAGIC) or bytes(buf[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+        raise SerializationError('not a utxo snapshot')
+    actual = _commitment(buf[:end])
+    if actual != bytes(buf[end:]).hex():
+        raise SerializationError('utxo snapshot is damaged')
+    if commitment is not None and actual != commitment:
+        raise SerializationError('utxo snapshot does not match commitment {0}'.format(commitment))
+    
+    _,offset = read_version(buf,len(SNAPSHOT_MAGIC))
+    tip,offset = read_hash(buf,offset)
+    n,offset = read_varint(buf,offset)
+    utxos = {}
+    for _ in range(n):
+        utxo,offset = UTXO.read_from(buf,offset)
+        utxos[utxo.pointer] = utxo
+    if offset != end:
+        raise SerializationError('{0} trailing bytes in utxo snapshot'.format(end - offset))
+    return UTXOBase(added = utxos,tip = tip)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Block template kept in step with a memory pool.
+
+The template watches a MemPool and mirrors every transaction that enters
+or leaves it, together with the running fee total and an incremental
+merkle tree. Transactions keep the order they entered the pool in,so a
+parent always comes before the children spending it.
+
+Only appends are incremental: while the pool just grows, a miner gets
+fresh work without rehashing the pool. Any removal (a connected block,
+an eviction, a conflict) makes the next refresh rebuild the whole tree
+once.
+"""
+
+from .merkletree import IncrementalMerkleTree
+
+
+class BlockTemplate(object):
+
+    def __init__(self,txs = ()):
+        self.clear()
+        for tx in txs:
+            self.tx_added(tx)
+
+    def clear(self):
+        #slot 0 is kept for the coinbase
+        self.txs = [None]
+        self.fees = 0
+        self._index = {}
+        self._holes = 0
+        self._merkle = IncrementalMerkleTree(['0'*64])
+
+    def tx_added(self,tx):
+        self._index[tx.id] = len(self.txs)
+        self.txs.append(tx)
+        if not self._holes:
+            self._merkle.append(tx.id)
+        self.fees += tx.fee
+
+    #leave a hole,refresh closes them all at once
+    def tx_removed(self,tx):
+        i = self._index.pop(tx.id)
+        self.txs[i] = None
+        self._holes += 1
+        self.fees -= tx.fee
+
+    """
+    put a new coinbase in slot 0,return the block txs and their merkle root
+    """
+    def refresh(self,coinbase):
+        if self._holes:
+            self._compact()
+        self.txs[0] = coinbase
+        self._merkle.update(0,coinbase.id)
+        return self.txs[:],self._merkle.root
+
+    def _compact(self):
+        self.txs = [self.txs[0]] + [tx for tx in self.txs[1:] if tx is not None]
+        self._index = {tx.id:i for i,tx in enumerate(self.txs) if i}
+        self._holes = 0
+        self._merkle = IncrementalMerkleTree(['0'*64] + [tx.id for tx in self.txs[1:]])
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return "BlockTemplate(txs:{0},fees:{1})".format(len(self),self.fees)
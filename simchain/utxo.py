@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Copy-on-write UTXO storage.
+
+UTXOBase holds the confirmed utxos at one chain tip. It never changes once
+built and is shared by every peer on that tip. A new base is a thin layer
+over its parent with the outputs a block created and the pointers it spent.
+
+UTXOSet is what a peer sees: a shared base plus a small private overlay
+with the unconfirmed outputs from its memory pool and anything it marked
+as spent. It behaves like the dict peers used before.
+"""
+
+import weakref
+from collections.abc import MutableMapping
+from .datatype import Pointer,UTXO
+from .params import Params
+
+
+#bases by tip hash,so peers that connect the same block share one base
+_bases = weakref.WeakValueDictionary()
+
+_DELETED = object()
+
+
+class UTXOBase(object):
+
+    def __init__(self,parent = None,added = None,removed = (),tip = None,
+                 prev = None,changed = None):
+        self.parent = parent
+        self.added = added or {}
+        self.removed = frozenset(removed)
+        self.tip = tip
+        self.depth = parent.depth + 1 if parent is not None else 0
+        #pointers that differ from prev,the base this one was built from
+        if changed is None:
+            changed = frozenset(self.added).union(self.removed)
+        self.changed = changed
+        self._prev = weakref.ref(prev) if prev is not None else None
+        self._by_addr = None
+        if parent is None:
+            self.size = len(self.added)
+        else:
+            self.size = parent.size \
+                        - sum(1 for p in self.removed if p not in self.added and p in parent) \
+                        + sum(1 for p in self.added if p not in parent)
+
+    def get(self,pointer,default = None):
+        base = self
+        while base is not None:
+            if pointer in base.added:
+                return base.added[pointer]
+            if pointer in base.removed:
+                return default
+            base = base.parent
+        return default
+
+    def __contains__(self,pointer):
+        return self.get(pointer) is not None
+
+    def __len__(self):
+        return self.size
+
+    def items(self):
+        seen,base = set(),self
+        while base is not None:
+            for pointer,utxo in base.added.items():
+                if pointer not in seen:
+                    yield pointer,utxo
+            seen.update(base.added)
+            seen.update(base.removed)
+            base = base.parent
+
+    def to_dict(self):
+        return dict(self.items())
+
+    #address -> pointers added in this layer,built on first use
+    def layer_index(self):
+        if self._by_addr is None:
+            self._by_addr = index_by_addr(self.added.items())
+        return self._by_addr
+
+    def pointers_of(self,addr):
+        layers,base = [],self
+        while base is not None:
+            layers.append(base)
+            base = base.parent
+        pointers = {}
+        for base in reversed(layers):
+            pointers.update(base.layer_index().get(addr,()))
+        return pointers
+
+    def derived_from(self,base):
+        return self._prev is not None and self._prev() is base
+
+    """
+    the base after connecting block,layers are squashed into a new root
+    once they get deeper than Params.MAX_UTXO_LAYERS
+    """
+    def connect(self,block):
+        spent = [vin.to_spend for tx in block.txs for vin in tx.tx_in
+                 if vin.to_spend is not None]
+        created = {}
+        for tx in block.txs:
+            for i,vout in enumerate(tx.tx_out):
+                pointer = Pointer(tx.id,i)
+                created[pointer] = UTXO(vout,pointer,tx.is_coinbase,True,True)
+
+        if self.depth + 1 > Params.MAX_UTXO_LAYERS:
+            flat = self.to_dict()
+            for pointer in spent:
+                flat.pop(pointer,None)
+            flat.update(created)
+            base = UTXOBase(added = flat,tip = block.hash,prev = self,
+                            changed = frozenset(created).union(spent))
+        else:
+            base = UTXOBase(self,created,spent,tip = block.hash,prev = self)
+        return base
+
+    def __repr__(self):
+        return "UTXOBase(tip:{0},size:{1},depth:{2})".format(self.tip,self.size,self.depth)
+
+
+def index_by_addr(items):
+    by_addr = {}
+    for pointer,utxo in items:
+        by_addr.setdefault(utxo.vout.to_addr,{})[pointer] = None
+    return by_addr
+
+
+def base_of_tip(tip):
+    return _bases.get(tip)
+
+
+def base_after_block(base,block):
+    cached = _bases.get(block.hash)
+    if cached is not None:
+        return cached
+    if base.tip != block.prev_block_hash:
+        base = _bases.get(block.prev_block_hash)
+        if base is None:
+            return None
+    new = base.connect(block)
+    _bases[block.hash] = new
+    return new
+
+
+class UTXOSet(MutableMapping):
+
+    def __init__(self,base = None):
+        self.base = base if base is not None else UTXOBase()
+        self._overlay = {}
+        self._overlay_by_addr = {}
+        self._size = len(self.base)
+
+    def __getitem__(self,pointer):
+        utxo = self._overlay.get(pointer)
+        if utxo is _DELETED:
+            raise KeyError(pointer)
+        if utxo is None:
+            utxo = self.base.get(pointer)
+            if utxo is None:
+                raise KeyError(pointer)
+        return utxo
+
+    def __contains__(self,pointer):
+        utxo = self._overlay.get(pointer)
+        if utxo is None:
+            return pointer in self.base
+        return utxo is not _DELETED
+
+    def __setitem__(self,pointer,utxo):
+        if pointer not in self:
+            self._size += 1
+        self._unindex(pointer)
+        self._overlay[pointer] = utxo
+        self._overlay_by_addr.setdefault(utxo.vout.to_addr,{})[pointer] = None
+
+    def __delitem__(self,pointer):
+        if pointer not in self:
+            raise KeyError(pointer)
+        self._unindex(pointer)
+        if pointer in self.base:
+            self._overlay[pointer] = _DELETED
+        else:
+            del self._overlay[pointer]
+        self._size -= 1
+
+    def _unindex(self,pointer):
+        utxo = self._overlay.get(pointer)
+        if utxo is not None and utxo is not _DELETED:
+            pointers = self._overlay_by_addr[utxo.vout.to_addr]
+            del pointers[pointer]
+            if not pointers:
+                del self._overlay_by_addr[utxo.vout.to_addr]
+
+    """
+    utxos paid to any of addrs,the cost depends on how many outputs the
+    addresses own and not on the size of the whole set
+    """
+    def utxos_of(self,addrs):
+        utxos = []
+        for addr in addrs:
+            pointers = self.base.pointers_of(addr)
+            pointers.update(self._overlay_by_addr.get(addr,()))
+            for pointer in pointers:
+                utxo = self.get(pointer)
+                if utxo is not None and utxo.vout.to_addr == addr:
+                    utxos.append(utxo)
+        return utxos
+
+    def __iter__(self):
+        overlay = self._overlay
+        for pointer,_ in self.base.items():
+            if pointer not in overlay:
+                yield pointer
+        for pointer,utxo in overlay.items():
+            if utxo is not _DELETED:
+                yield pointer
+
+    def __len__(self):
+        return self._size
+
+    """
+    base can replace the shared base when it holds the same utxos,e.g. a
+    base loaded from a snapshot of the same tip
+    """
+    def copy(self,base = None):
+        other = UTXOSet(base if base is not None else self.base)
+        other._overlay = self._overlay.copy()
+        other._overlay_by_addr = {addr:pointers.copy()
+                                  for addr,pointers in self._overlay_by_addr.items()}
+        other._size = self._size
+        return other
+
+    @property
+    def overlay_size(self):
+        return len(self._overlay)
+
+    """
+    move onto another shared base without changing what this set contains,
+    only pointers that differ between the two bases or sit in the overlay
+    have to be looked at when one base was built from the other
+    """
+    def rebase(self,base):
+        if base is self.base:
+            return
+        if base.derived_from(self.base):
+            pointers = set(self._overlay).union(base.changed)
+        elif self.base.derived_from(base):
+            pointers = set(self._overlay).union(self.base.changed)
+        else:
+            pointers = set(self).union(p for p,_ in base.items())
+        view = {p:self.get(p) for p in pointers}
+
+        self.base,self._overlay = base,{}
+        for pointer,utxo in view.items():
+            in_base = base.get(pointer)
+            if utxo is None:
+                if in_base is not None:
+                    self._overlay[pointer] = _DELETED
+            elif utxo != in_base:
+                self._overlay[pointer] = utxo
+        self._overlay_by_addr = index_by_addr(
+                (p,u) for p,u in self._overlay.items() if u is not _DELETED)
+        self._size = len(base) \
+                     + sum(1 for p,u in self._overlay.items()
+                           if u is not _DELETED and p not in base) \
+                     - sum(1 for u in self._overlay.values() if u is _DELETED)
+
+    def __repr__(self):
+        return "UTXOSet(base:{0},overlay:{1})".format(self.base,len(self._overlay))
@@ -1,7 +1,74 @@
 
 
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from .logger import logger
 from .ecc import convert_pubkey_to_addr,VerifyingKey,sha256d
+from .params import Params
+
+#opcodes are small ints,OP_PUSH is followed by the value it pushes
+OP_PUSH = 0
+OPCODES = {name:code for code,name in enumerate((
+            "OP_ADD",
+            "OP_MINUS",
+            "OP_MUL",
+            "OP_EQ",
+            "OP_EQUAL",
+            "OP_CHECKSIG",
+            "OP_ADDR",
+            "OP_DUP",
+            "OP_NDUP",
+            "OP_CHECKMULSIG",
+            "OP_MULHASH",
+            ),1)}
+
+OPCODE_NAMES = {code:name for name,code in OPCODES.items()}
+
+_OP_DUP,_OP_ADDR,_OP_EQ,_OP_CHECKSIG = (OPCODES[name] for name in
+                                        ("OP_DUP","OP_ADDR","OP_EQ","OP_CHECKSIG"))
+_OP_NDUP,_OP_CHECKMULSIG = OPCODES["OP_NDUP"],OPCODES["OP_CHECKMULSIG"]
+
+
+#a compiled script,what LittleMachine runs
+class Script(tuple):
+
+    def __add__(self,other):
+        return Script(tuple.__add__(self,other))
+
+    """
+    sig pubkey OP_DUP OP_ADDR addr OP_EQ OP_CHECKSIG,every standard input
+    """
+    @property
+    def is_pay_to_addr(self):
+        return len(self) == 10 and self[0] == OP_PUSH and self[2] == OP_PUSH \
+               and self[4] == _OP_DUP and self[5] == _OP_ADDR \
+               and self[6] == OP_PUSH and self[8] == _OP_EQ \
+               and self[9] == _OP_CHECKSIG
+
+
+def compile_script(script):
+    if isinstance(script,Script):
+        return script
+    compiled = []
+    for op in script:
+        if isinstance(op,str) and op in OPCODES:
+            compiled.append(OPCODES[op])
+        elif isinstance(op,(str,bytes,int,bool)):
+            compiled += (OP_PUSH,op)
+        else:
+            logger.info('Uknow opcode: {0}'.format(op))
+    return Script(compiled)
+
+def push_script(*values):
+    return Script(v for value in values for v in (OP_PUSH,value))
+
+#pubkey scripts are shared by every output to the same address
+@lru_cache(maxsize = 1 << 16)
+def compile_pubkey_script(pubkey_script):
+    return compile_script(pubkey_script.split(' '))
+
 
 class Stack(list):
     
@@ -10,11 +77,76 @@ class Stack(list):
     def peek(self):
         return self[-1]
 
+
+"""
+inputs whose script already ran successfully,keyed by (tx id,input index,
+pubkey script),the least recently used key goes first once the cache is full,
+peers validating a block in parallel threads share it under a lock
+"""
+class SignatureCache(object):
+
+    def __init__(self,max_size = None):
+        self.max_size = max_size or Params.MAX_SIG_CACHE_SIZE
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self,key):
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self,key):
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self.hits = self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits/total if total else 0.
+
+    def __contains__(self,key):
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return "SignatureCache(size:{0},hits:{1},misses:{2})".format(
+                len(self._keys),self.hits,self.misses)
+
     
+"""
+scripts run within budgets of opcodes,signature checks and stack size
+from Params,a script going over one fails with the reason in error,
+profile = True records count and secs of every opcode in profile
+"""
 class LittleMachine(object):
 
-    def __init__(self):
+    def __init__(self,profile = None):
         self.stack = Stack()
+        self.max_ops = Params.MAX_SCRIPT_OPS
+        self.max_sigops = Params.MAX_SCRIPT_SIGOPS
+        self.max_stack = Params.MAX_STACK_SIZE
+        if profile is None:
+            profile = Params.PROFILE_SCRIPTS
+        self.profile = {} if profile else None
+        self.error = None
+        self.n_ops = 0
+        self.n_sigops = 0
         self._map = {
             "OP_ADD":          self.add,
             "OP_MINUS":        self.minus,
@@ -28,14 +160,24 @@ class LittleMachine(object):
             "OP_CHECKMULSIG" : self.check_mulsig,
             "OP_MULHASH":      self.calc_mulhash,
             }
+        #the same handlers indexed by opcode
+        self._ops = [None]*(len(OPCODES) + 1)
+        for name,code in OPCODES.items():
+            self._ops[code] = self._map[name]
 
 
+    """
+    script is a compiled Script or a list of opcode names and values
+    """
     def set_script(self,script,message = b''):
         self.clear()
         self.result = True
         self.pointer = 0
         self.message = message
-        self.script = script
+        self.script = compile_script(script)
+        self.error = None
+        self.n_ops = 0
+        self.n_sigops = 0
         
 
     def clear(self):
@@ -131,17 +273,89 @@ class LittleMachine(object):
         pk_str = self.pop()
         self.push(convert_pubkey_to_addr(pk_str))
         
+    def abort(self,error):
+        self.error = error
+        self.result = False
+        return False
+
+    #operands of OP_NDUP and OP_CHECKMULSIG are checked before they run
+    def charge(self,op):
+        self.n_ops += 1
+        if self.n_ops > self.max_ops:
+            return self.abort('too many opcodes')
+        if op == _OP_CHECKSIG:
+            self.n_sigops += 1
+        elif op == _OP_NDUP or op == _OP_CHECKMULSIG:
+            n = self.stack[-1] if self.stack else None
+            if not isinstance(n,int) or isinstance(n,bool) or not 0 <= n < len(self.stack):
+                return self.abort('bad count for {0}'.format(OPCODE_NAMES[op]))
+            #OP_NDUP with 0 copies the whole stack below the count
+            copies = n or len(self.stack) - 1
+            if op == _OP_NDUP and len(self.stack) + copies > self.max_stack:
+                return self.abort('stack too deep')
+            if op == _OP_CHECKMULSIG:
+                self.n_sigops += n
+        if self.n_sigops > self.max_sigops:
+            return self.abort('too many signature checks')
+        return True
+
     def run(self):
-        while (self.pointer < len(self.script)):
-            op = self.script[self.pointer]
-            self.pointer += 1
-            self.evaluate(op)
+        script = self.script
+        if self.pointer == 0 and self.profile is None and script.is_pay_to_addr:
+            return self.run_pay_to_addr()
+        
+        ops,stack,n = self._ops,self.stack,len(script)
+        max_stack,profile = self.max_stack,self.profile
+        i = self.pointer
+        try:
+            while i < n:
+                op = script[i]
+                if op == OP_PUSH:
+                    stack.append(script[i+1])
+                    i += 2
+                else:
+                    i += 1
+                    if not self.charge(op):
+                        return False
+                    if profile is None:
+                        ops[op]()
+                    else:
+                        start = time.perf_counter()
+                        ops[op]()
+                        record = profile.setdefault(OPCODE_NAMES[op],[0,0.])
+                        record[0] += 1
+                        record[1] += time.perf_counter() - start
+                if len(stack) > max_stack:
+                    return self.abort('stack too deep')
+        except IndexError:
+            return self.abort('stack underflow')
+        finally:
+            self.pointer = i
             
         if not self.result:
             return False
+        elif not stack:
+            return self.abort('stack underflow')
         else:
             return self.peek()
 
+    #what the opcodes of a pay to address script do,without the stack,
+    #it stays within any budget that lets one signature check through
+    def run_pay_to_addr(self):
+        script = self.script
+        sig,pk_str,addr = script[1],script[3],script[7]
+        self.pointer = len(script)
+        self.n_ops,self.n_sigops = 4,1
+        if self.n_ops > self.max_ops or self.n_sigops > self.max_sigops:
+            return self.abort('script over budget')
+        if convert_pubkey_to_addr(pk_str) != addr:
+            self.result = False
+            return False
+        self.push(sig)
+        self.push(pk_str)
+        self.check_sig()
+        return self.peek()
+
 
 if __name__ == "__main__":
     from datatype import Vin,Vout